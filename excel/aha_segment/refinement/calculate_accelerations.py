@@ -3,8 +3,6 @@ import os
 import pandas as pd
 from loguru import logger
 
-from excel.global import CHECKED_PATH, CONDENSED_PATH
-
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 pd.set_option('display.width', None)
@@ -78,7 +76,7 @@ class CalculateAcceleration:
 
 
 if __name__ == '__main__':
-    src = os.path.join(CHECKED_PATH, 'complete')
-    dst = CONDENSED_PATH
+    src = os.path.join('/home/sebalzer/Documents/Mike_init/tests/train/4_checked', 'complete')
+    dst = '/home/sebalzer/Documents/Mike_init/tests/train/6_condensed'
     ca = CalculateAcceleration(src, dst)
     ca()
@@ -1,6 +1,9 @@
 import os
+import tempfile
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 from loguru import logger
 
 pd.set_option('display.max_columns', None)
@@ -15,34 +18,59 @@ class MergeCasesOfPolarMaps:
     def __init__(self, src: str, dst: str) -> None:
         self.src = src
         self.dst = dst
-        self.memory = {}
 
     def __call__(self) -> None:
-        subjects = os.listdir(self.src)
-        subject_path = os.path.join(self.src, subjects[0])
-        tables = os.listdir(subject_path)
-        tables = ['_'.join(table.split('_')[1:]) for table in tables]
+        subjects = sorted(os.listdir(self.src))
+        tables = set()
+        for subject in subjects:  # union of tables over all subjects, not only the first one
+            for table in os.listdir(os.path.join(self.src, subject)):
+                tables.add('_'.join(table.split('_')[1:]))
 
-        for table in tables:
+        for table in sorted(tables):
             if 'polarmap' in table:
                 logger.info(f'-> {table}')
                 table_name = table.replace('.xlsx', '')
-                self.memory = {}
-                for subject in subjects:
-                    file_name = f'{subject}_{table}'
-                    file_path = os.path.join(self.src, subject, file_name)
-                    df = pd.read_excel(file_path)
-                    self.memory[subject] = df
-                self.merge_column_wise(table_name)
-
-    def merge_column_wise(self, table_name) -> None:
-        columns = self.memory[list(self.memory.keys())[0]].columns
+                with tempfile.TemporaryDirectory() as spill_dir:
+                    spilled = self.spill_subjects(table, subjects, spill_dir)
+                    self.merge_column_wise(table_name, subjects, spilled)
+
+    def spill_subjects(self, table: str, subjects: list, spill_dir: str) -> dict:
+        """Read the table of each subject once and spill it to parquet, which allows reading single columns"""
+        spilled = {}  # subject index -> parquet path
+        for index, subject in enumerate(subjects):  # stream subjects, one table in memory at a time
+            file_path = os.path.join(self.src, subject, f'{subject}_{table}')
+            if not os.path.isfile(file_path):
+                logger.warning(f'Subject {subject} has no table {table}, filling with NaN')
+                continue
+            df = pd.read_excel(file_path)
+            df.columns = df.columns.astype(str)
+            for column in df.select_dtypes(include='object').columns:  # parquet needs one type per column
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+            spilled[index] = os.path.join(spill_dir, f'{index}.parquet')
+            df.to_parquet(spilled[index], index=False)
+        return spilled
+
+    def merge_column_wise(self, table_name: str, subjects: list, spilled: dict) -> None:
+        """Assemble and write one output column at a time from column-projected reads of the spilled tables"""
+        columns, n_rows, subject_columns = {}, 0, {}  # union of columns in order of appearance
+        for index, path in spilled.items():
+            metadata = pq.read_metadata(path)
+            subject_columns[index] = set(metadata.schema.names)
+            columns.update(dict.fromkeys(metadata.schema.names))
+            n_rows = max(n_rows, metadata.num_rows)
+
+        table_name = table_name.replace('/', '-')
         for column in columns:
-            df = pd.DataFrame(columns=self.memory.keys())
-            for subject in self.memory:
-                df[subject] = self.memory[subject][column]
+            values = {}
+            for index, path in spilled.items():
+                if column in subject_columns[index]:
+                    values[index] = pd.read_parquet(path, columns=[column])[column].to_numpy()
+            numeric = all(np.issubdtype(arr.dtype, np.number) for arr in values.values())
+            arr = np.full((n_rows, len(subjects)), np.nan, dtype=float if numeric else object)
+            for index, subject_values in values.items():
+                arr[: len(subject_values), index] = subject_values
+            df = pd.DataFrame(arr, columns=subjects)
 
-            table_name = table_name.replace('/', '-')
             column = column.replace('/', '-')
             file_path = os.path.join(self.dst, table_name, f'{table_name}_{column}.xlsx')
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
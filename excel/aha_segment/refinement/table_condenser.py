@@ -1,8 +1,11 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from loguru import logger
 
+from excel.global_helpers import read_table
+
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
@@ -10,27 +13,46 @@ pd.set_option('display.width', None)
 pd.set_option('display.max_colwidth', None)
 
 
+def relevant_column(col) -> bool:
+    """Columns of interest, evaluated on the header before the table body is parsed"""
+    return 'sample' in str(col) or 'AHA' in str(col)
+
+
 class TableCondenser:
     """Narrows down the table to the columns of interest"""
 
-    def __init__(self, src: str, dst: str) -> None:
+    def __init__(self, src: str, dst: str, workers: int = 1, file_format: str = 'xlsx') -> None:
         self.src = src
         self.dst = dst
+        self.workers = workers  # number of processes, subjects are distributed among them
+        self.file_format = file_format  # 'xlsx' or 'parquet'
+        self.dims = ['2d', '3d']
+        # self.dims = ['2d']
         self.memory = {}
 
+        if self.file_format not in ['xlsx', 'parquet']:
+            raise ValueError(f'Unknown file format {self.file_format}, must be either xlsx or parquet')
+
     def __call__(self) -> None:
-        dims = ['2d', '3d']
-        # dims = ['2d']
-        for dim in dims:
-            for subject in self.loop_subjects():
-                for table in self.loop_tables(subject, dim):
-                    df = self.clean(subject, dim, table)
-                    self.save(df, subject, dim, table)
+        subjects = list(self.loop_subjects())
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(self.condense_subject, subjects))  # list() to raise errors of worker processes
+        else:
+            for subject in subjects:
+                self.condense_subject(subject)
+
+    def condense_subject(self, subject: str) -> None:
+        """Condense all tables of one subject"""
+        logger.info(f'-> {subject}')
+        for dim in self.dims:
+            for table in self.loop_tables(subject, dim):
+                df = self.clean(subject, dim, table)
+                self.save(df, subject, dim, table)
 
     def loop_subjects(self) -> str:
         """Loop over subjects"""
         for subject in os.listdir(self.src):
-            logger.info(f'-> {subject}')
             yield subject
 
     def loop_tables(self, subject: str, dim: str) -> str:
@@ -42,14 +64,11 @@ class TableCondenser:
                     yield table
 
     def clean(self, subject: str, dim: str, table: str) -> pd.DataFrame or None:
-        """Clean table"""
+        """Clean table, only the columns of interest are read"""
         table_path = os.path.join(self.src, subject, dim, table)
-        df = pd.read_excel(table_path)
+        df = read_table(table_path, columns=relevant_column)
 
         if not df.empty:
-            # keep only columns of interest
-            # df = df[[col for col in df.columns if 'sample' in col or 'AHA' in col or 'slice' in col or 'roi' in col]]
-            df = df[[col for col in df.columns if 'sample' in col or 'AHA' in col]]
             return df
         return None
 
@@ -58,11 +77,18 @@ class TableCondenser:
         if df is not None:
             export_path = os.path.join(self.dst, subject, dim, table)
             os.makedirs(os.path.dirname(export_path), exist_ok=True)
-            df.to_excel(export_path, index=False)
+            if self.file_format == 'parquet':
+                df.columns = df.columns.astype(str)  # parquet requires string column names
+                object_cols = df.select_dtypes(include='object').columns
+                # mixed info cols, e.g. AHA Segment = ['global', 1, ...], missing values stay missing
+                df[object_cols] = df[object_cols].where(df[object_cols].isna(), df[object_cols].astype(str))
+                df.to_parquet(export_path.replace('.xlsx', '.parquet'), index=False)
+            else:
+                df.to_excel(export_path, index=False)
 
 
 if __name__ == '__main__':
     src = os.path.join('/home/sebalzer/Documents/Mike_init/tests/train/4_checked', 'complete')
     dst = '/home/sebalzer/Documents/Mike_init/tests/train/6_condensed'
-    tc = TableCondenser(src, dst)
+    tc = TableCondenser(src, dst, workers=os.cpu_count())
     tc()
@@ -1,43 +1,83 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from loguru import logger
 
+from excel.global_helpers import read_table
+
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 pd.set_option('display.width', None)
 pd.set_option('display.max_colwidth', None)
 
+METRIC_NAMES = [
+    'longit_strain_rate',
+    'radial_strain_rate',
+    'circumf_strain_rate',
+    'longit_velocity',
+    'radial_velocity',
+    'circumf_velocity',
+    'longit_acceleration',
+    'radial_acceleration',
+    'circumf_acceleration',
+    'longit_strain-acc',
+    'radial_strain-acc',
+    'circumf_strain-acc',
+]
+
 
 class MergeSegments:
     """Merge table of subjects"""
 
-    def __init__(self, src: str, dst: str) -> None:
+    def __init__(self, src: str, dst: str, workers: int = 1) -> None:
         self.src = src
         self.dst = dst
+        self.workers = workers  # number of processes used to write the merged tables
         self.memory = {}
 
-    def __call__(self, dim, name) -> None:
-        self.aggregate_data_frames(dim, name)
-        self.merge_column_wise(dim, name)
-        self.merge_row_wise(dim, name)
-
-    def aggregate_data_frames(self, dim: str, name: str) -> None:
-        """Aggregate data frames"""
-        self.memory = {}
+    def __call__(self, dim: str, names: str or list) -> None:
+        names = [names] if isinstance(names, str) else list(names)
+        buckets = self.aggregate_data_frames(dim, names)  # single walk for all metric names
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        pending = []
+        try:
+            for name in names:
+                self.memory = buckets.pop(name)  # release input tables no longer needed by later names
+                if not self.memory:
+                    logger.warning(f'No tables found for {name} in {dim}, skipping...')
+                    continue
+                outputs = self.merge_column_wise(dim, name) + self.merge_row_wise(dim, name)
+                self.wait(pending)  # at most one name's merged tables are held by the pool
+                pending = self.save_all(outputs, executor)
+            self.wait(pending)
+        finally:
+            self.memory = {}
+            if executor is not None:
+                executor.shutdown()
+
+    def aggregate_data_frames(self, dim: str, names: list) -> dict:
+        """Aggregate data frames, each file is read once and routed to all matching names"""
+        buckets = {name: {} for name in names}
         for root, _, files in os.walk(self.src):
             if root.endswith(dim):  # filter w.r.t. dim
                 for file in files:
-                    if file.endswith('.xlsx') and name in file:
+                    if not file.endswith(('.xlsx', '.parquet')):
+                        continue
+                    matches = [name for name in names if name in file]
+                    if matches:
                         file_path = os.path.join(root, file)
                         logger.info(f'-> {file}')
-                        df = pd.read_excel(file_path)
-                        table_name = file.replace('.xlsx', '')
-                        self.memory[table_name] = df
+                        df = read_table(file_path)
+                        table_name = os.path.splitext(file)[0]
+                        for name in matches:
+                            buckets[name][table_name] = df
+        return buckets
 
-    def merge_column_wise(self, dim: str, table_name) -> None:
+    def merge_column_wise(self, dim: str, table_name) -> list:
         """Merge columns of data frames"""
+        outputs = []
         columns = self.memory[list(self.memory.keys())[0]].columns  # get column names of first subject
         # cols here = [sample_0, sample_1, ...]
         for column in columns:
@@ -51,23 +91,22 @@ class MergeSegments:
                 header = [f'case_{x.split("_")[0]}' for x in header]
                 df.columns = header
                 df.rename(index={0: 'global'}, inplace=True)
-                self.save(df, dim, f'aha_{dim}_{table_name}_{column}')
+                outputs.append((df, dim, f'aha_{dim}_{table_name}_{column}'))
+        return outputs
 
-    def merge_row_wise(self, dim: str, table_name) -> None:
+    def merge_row_wise(self, dim: str, table_name) -> list:
         """Merge columns of data frames"""
-        # print(self.memory[list(self.memory.keys())[0]])
+        outputs = []
         tmp_df = self.memory[list(self.memory.keys())[0]]
         tmp_df = tmp_df.transpose()
         columns = tmp_df.columns.tolist()
+        transposed = {subject: df.transpose() for subject, df in self.memory.items()}  # transpose once per subject
         # cols here = [0, 1, ...]
         for column in columns:
             df = pd.DataFrame(columns=self.memory.keys())
 
             for subject in self.memory:
-                x = self.memory[subject].transpose()
-                # print(x)
-                # print(column)
-                df[subject] = x[column]
+                df[subject] = transposed[subject][column]
 
             header = df.columns.tolist()
             header = [f'case_{x.split("_")[0]}' for x in header]
@@ -76,35 +115,41 @@ class MergeSegments:
             if column == 0:
                 column = 'global'
             df = df.iloc[1:]  # remove global row
-            self.save(df, dim, f'aha_{dim}_{table_name}_{column}')
+            outputs.append((df, dim, f'aha_{dim}_{table_name}_{column}'))
+        return outputs
+
+    def save_all(self, outputs: list, executor: ProcessPoolExecutor = None) -> list:
+        """Save merged tables, or submit them to the process pool and return the futures"""
+        if executor is None:
+            for df, dim, name in outputs:
+                self.save(df, dim, name)
+            return []
+        return [executor.submit(save_table, df, self.dst, dim, name) for df, dim, name in outputs]
+
+    @staticmethod
+    def wait(futures: list) -> None:
+        """Wait for submitted tables, raising errors of worker processes"""
+        for future in futures:
+            future.result()
 
     def save(self, df: pd.DataFrame, dim: str, name: str) -> None:
-        name = name.replace('/', '-')
-        file_path = os.path.join(self.dst, dim, f'{name}.xlsx')
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        df.to_excel(file_path, index=True)
+        save_table(df, self.dst, dim, name)
+
+
+def save_table(df: pd.DataFrame, dst: str, dim: str, name: str) -> None:
+    """Save merged table"""
+    name = name.replace('/', '-')
+    file_path = os.path.join(dst, dim, f'{name}.xlsx')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    df.to_excel(file_path, index=True)
 
 
 if __name__ == '__main__':
     src = '/home/sebalzer/Documents/Mike_init/tests/train/6_condensed'
     dst = '/home/sebalzer/Documents/Mike_init/tests/train/7_merged'
-    tm = MergeSegments(src, dst)
+    tm = MergeSegments(src, dst, workers=4)
 
     # dims = ['2d', '3d']
     dims = ['3d']
     for dim in dims:
-        for name in [
-            'longit_strain_rate',
-            'radial_strain_rate',
-            'circumf_strain_rate',
-            'longit_velocity',
-            'radial_velocity',
-            'circumf_velocity',
-            'longit_acceleration',
-            'radial_acceleration',
-            'circumf_acceleration',
-            'longit_strain-acc',
-            'radial_strain-acc',
-            'circumf_strain-acc',
-        ]:
-            tm(dim, name)
+        tm(dim, METRIC_NAMES)
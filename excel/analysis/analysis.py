@@ -1,7 +1,6 @@
 """ Analysis module for all kinds of experiments
 """
 
-import os
 import sys
 
 import hydra
@@ -10,9 +9,11 @@ import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
 
 from excel.analysis.utils.exploration import ExploreData
 from excel.analysis.utils.merge_data import MergeData
+from excel.analysis.utils.plots import Plotter
 from excel.analysis.verifications import VerifyFeatures
 from excel.analysis.utils.helpers import target_statistics
 
@@ -36,17 +37,19 @@ class Analysis:
 
     def __call__(self) -> None:
         new_name = f'{self.experiment_name}_imputed' if self.impute else self.experiment_name
-        merged_path = os.path.join(self.src_dir, '5_merged', f'{new_name}.xlsx')
         self.config.analysis.experiment.name = new_name
 
-        # Data merging
-        if os.path.isfile(merged_path) and not self.overwrite:
+        # Data merging, cached w.r.t. relevant config and input tables
+        merger = MergeData(self.config)
+        merged_path = merger.cache_path()
+        if merger.is_cached() and not self.overwrite:
             logger.info('Merged data available, skipping merge step...')
         else:
-            merger = MergeData(self.config)
             merger()
 
-        data = pd.read_excel(merged_path)  # Read in merged data
+        data = pd.read_parquet(merged_path)  # Read in merged data
+        metadata = list(self.config.analysis.experiment.metadata)  # keep metadata cols which survived merging
+        self.config.analysis.experiment.metadata = [col for col in metadata if col in data.columns]
         data = data.set_index('subject')  # Use subject ID as index column
         task, stratify = target_statistics(data, self.target_label)
 
@@ -63,11 +66,15 @@ class Analysis:
         else:
             raise ValueError(f'Value {self.explore_frac} is invalid, must be float in (0, 1)')
 
-        explorer = ExploreData(self.config, explore_data, task)
+        # exploration and verification enqueue their plots, which render alongside the computation
+        run_config = self.config.analysis.run
+        plotter = Plotter(run_config.get('plots', 'all'), run_config.get('plot_workers', 1))
+        explorer = ExploreData(self.config, explore_data, task, plotter)
         features = explorer()
 
-        verify = VerifyFeatures(self.config, verification_data, verification_data_test, features, task)
+        verify = VerifyFeatures(self.config, verification_data, verification_data_test, features, task, plotter)
         verify()
+        plotter.wait()
 
 
 if __name__ == '__main__':
@@ -77,6 +84,7 @@ if __name__ == '__main__':
         logger.remove()
         logger.add(sys.stderr, level=config.logging_level)
         analysis = Analysis(config)
-        analysis()
+        with threadpool_limits(limits=config.analysis.run.get('threads_per_job', 1)):  # limit BLAS threads
+            analysis()
 
     main()
@@ -1,15 +1,19 @@
+import json
 import os
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
+from joblib import Parallel, delayed, parallel_backend
 from loguru import logger
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_selection import RFECV
+from sklearn.base import clone
+from sklearn.feature_selection import RFE, RFECV, f_classif, f_regression
 from sklearn.inspection import permutation_importance
+from sklearn.metrics import check_scoring
+from xlsxwriter.utility import xl_rowcol_to_cell
 
-from excel.analysis.utils.helpers import init_estimator, split_data
+from excel.analysis.utils import plots
+from excel.analysis.utils.helpers import correlation_matrix, init_estimator, split_data
 
 
 class AnalyseVariables:
@@ -22,7 +26,13 @@ class AnalyseVariables:
         self.corr_method = None
         self.corr_thresh = None
         self.corr_drop_features = None
+        self.corr_importance = 'permutation'
+        self.corr_n_repeats = 5
         self.scoring = None
+        self.class_weight = None
+        self.task = None
+        self.n_jobs = None
+        self.plotter = plots.Plotter()
 
     def univariate_analysis(self, data: pd.DataFrame):
         """
@@ -33,36 +43,7 @@ class AnalyseVariables:
             self.metadata.remove(self.target_label)
         to_analyse, _, _ = split_data(data, self.metadata, self.target_label, remove_mdata=True)
 
-        # box plot for each feature w.r.t. target_label
-        data_long = to_analyse.melt(id_vars=[self.target_label])
-        sns.boxplot(
-            data=data_long,
-            x='value',
-            y='variable',
-            hue=self.target_label,
-            orient='h',
-            meanline=True,
-            showmeans=True,
-        )
-        plt.axvline(x=0, alpha=0.7, color='grey', linestyle='--')
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.job_dir, f'box_plot_{self.target_label}.pdf'))
-        plt.clf()
-
-        to_analyse = to_analyse.drop(self.target_label, axis=1)  # now remove hue column
-
-        # box plot for each feature
-        sns.boxplot(data=to_analyse, orient='h', meanline=True, showmeans=True, whis=1.5)
-        plt.axvline(x=0, alpha=0.7, color='grey', linestyle='--')
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.job_dir, 'box_plot.pdf'))
-        plt.clf()
-
-        # plot distribution for each feature
-        sns.displot(data=to_analyse, kind='kde')
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.job_dir, 'dis_plot.pdf'))
-        plt.clf()
+        self.plotter.submit(plots.univariate_plots, self.job_dir, to_analyse, self.target_label)
         return data
 
     def bivariate_analysis(self, data):
@@ -77,42 +58,54 @@ class AnalyseVariables:
         """
         to_analyse = data.drop(self.target_label, axis=1)
         target = data[self.target_label]
-        matrix = to_analyse.corr(method=self.corr_method).round(2)
+        matrix = correlation_matrix(to_analyse, self.corr_method).round(2)
 
         if self.corr_drop_features:
-            # calculate feature importances
-            estimator = RandomForestClassifier(random_state=self.seed)
-            estimator.fit(to_analyse, target)
-            perm_importances = permutation_importance(estimator, to_analyse, target, scoring=self.scoring)
-            importances = perm_importances.importances_mean
-            importances = pd.Series(importances, index=to_analyse.columns)
-            importances = importances.sort_values(ascending=False)
-
-            matrix = matrix.reindex(
-                index=importances.index, columns=importances.index
-            )  # sort matrix w.r.t. feature importance
-            abs_corr = matrix.abs()
-            upper_tri = abs_corr.where(np.triu(np.ones(abs_corr.shape), k=1).astype(bool))
-
-            cols_to_drop = [col for col in upper_tri.columns if any(upper_tri[col] > self.corr_thresh)]
-            to_analyse = to_analyse.drop(cols_to_drop, axis=1)
+            importances = self.__importances(to_analyse, target)
+            order = np.argsort(-importances, kind='stable')  # most important first
+            keep = np.zeros(len(order), dtype=bool)
+            keep[order] = prune_correlated(matrix.to_numpy()[np.ix_(order, order)], self.corr_thresh)
+
+            to_analyse = to_analyse.loc[:, keep]
             logger.info(
-                f'Removed {len(cols_to_drop)} redundant features with correlation above {self.corr_thresh}, '
+                f'Removed {np.sum(~keep)} redundant features with correlation above {self.corr_thresh}, '
                 f'number of remaining features: {len(to_analyse.columns)}'
             )
-            matrix = to_analyse.corr(method=self.corr_method).round(2)
+            matrix = matrix.loc[keep, keep]  # correlation of remaining features is unchanged
 
-        # plot correlation heatmap
-        fig = plt.figure(figsize=(20, 20))
-        sns.heatmap(matrix, annot=True, xticklabels=True, yticklabels=True, cmap='viridis')
-        plt.xticks(rotation=90)
-        plt.savefig(os.path.join(self.job_dir, 'corr_plot.pdf'))
-        plt.close(fig)
+        self.plotter.submit(plots.correlation_heatmap, self.job_dir, matrix)
 
         data = pd.concat((to_analyse, data[self.target_label]), axis=1)
 
         return data
 
+    def __importances(self, to_analyse: pd.DataFrame, target: pd.Series) -> np.ndarray:
+        """Feature importances used to decide which of two correlated features to keep"""
+        if self.corr_importance == 'univariate':  # no model fit, cheapest for large feature sets
+            score_func = f_classif if self.task == 'classification' else f_regression
+            scores, _ = score_func(to_analyse, target)
+            return np.nan_to_num(scores)  # constant features have undefined scores
+
+        estimator, _, scoring = init_estimator(
+            'forest', self.task, self.seed, self.scoring, self.class_weight, n_jobs=self.n_jobs
+        )
+        estimator.fit(to_analyse, target)
+        if self.corr_importance == 'impurity':
+            return estimator.feature_importances_
+        if self.corr_importance == 'permutation':
+            estimator.set_params(n_jobs=1)  # permutation_importance parallelises over features, avoid nesting
+            perm_importances = permutation_importance(
+                estimator,
+                to_analyse,
+                target,
+                scoring=scoring,
+                n_repeats=self.corr_n_repeats,
+                random_state=self.seed,
+                n_jobs=self.n_jobs,
+            )
+            return perm_importances.importances_mean
+        raise ValueError(f'Invalid correlation importance {self.corr_importance}, check -> corr_importance')
+
     def drop_outliers(self, data: pd.DataFrame):
         """Detect outliers in the data, optionally removing or further investigating them
 
@@ -122,19 +115,11 @@ class AnalyseVariables:
             remove (bool, optional): whether to remove outliers. Defaults to True.
             investigate (bool, optional): whether to investigate outliers. Defaults to False.
         """
-        # Split data and metadata
-        mdata = data[self.metadata]
-        whiskers = 1.5
-        to_analyse = data.drop(self.metadata, axis=1, errors='ignore')
-
-        # Calculate quartiles, interquartile range and limits
-        q1, q3 = np.percentile(to_analyse, [25, 75], axis=0)
-        iqr = q3 - q1
-        lower_limit = q1 - whiskers * iqr
-        upper_limit = q3 + whiskers * iqr
-        # logger.debug(f'\nlower limit: {lower_limit}\nupper limit: {upper_limit}')
-
-        to_analyse = to_analyse.mask(to_analyse.le(lower_limit) | to_analyse.ge(upper_limit))
+        to_analyse, mdata = self.__split_metadata(data)
+        values = to_analyse.to_numpy(dtype=np.float64)
+        lower_limit, upper_limit = outlier_bounds(values)
+
+        to_analyse = to_analyse.mask(outlier_mask(values, lower_limit, upper_limit))
         to_analyse.to_excel(os.path.join(self.job_dir, 'outliers_removed.xlsx'), index=True)
 
         # Add metadata again
@@ -152,30 +137,22 @@ class AnalyseVariables:
             remove (bool, optional): whether to remove outliers. Defaults to True.
             investigate (bool, optional): whether to investigate outliers. Defaults to False.
         """
-        # Split data and metadata
-        mdata = data[self.metadata]
-        whiskers = 1.5
-        to_analyse = data.drop(self.metadata, axis=1, errors='ignore')
-
-        # Calculate quartiles, interquartile range and limits
-        q1, q3 = np.percentile(to_analyse, [25, 75], axis=0)
-        iqr = q3 - q1
-        lower_limit = q1 - whiskers * iqr
-        upper_limit = q3 + whiskers * iqr
-        # logger.debug(f'\nlower limit: {lower_limit}\nupper limit: {upper_limit}')
-
-        high_data = to_analyse.copy(deep=True)
-        # Remove rows without outliers
-        # high_data = high_data.drop(high_data.between(lower_limit, upper_limit).all(), axis=0)
-        # Add metadata again
-        high_data = pd.concat((high_data, mdata), axis=1).sort_values(by=['subject'])
-
-        # Highlight outliers in table
-        high_data.style.apply(
-            lambda _: highlight(df=high_data, lower_limit=lower_limit, upper_limit=upper_limit), axis=None
-        ).to_excel(os.path.join(self.job_dir, 'investigate_outliers.xlsx'), index=True)
+        to_analyse, mdata = self.__split_metadata(data)
+        values = to_analyse.to_numpy(dtype=np.float64)
+        lower_limit, upper_limit = outlier_bounds(values)
+        outliers = outlier_table(to_analyse, outlier_mask(values, lower_limit, upper_limit), lower_limit, upper_limit)
+        logger.info(f'Found {len(outliers)} outliers in {outliers["subject"].nunique()} subjects')
+
+        high_data = pd.concat((to_analyse, mdata), axis=1).sort_values(by=['subject'])  # add metadata again
+        write_highlighted_outliers(
+            os.path.join(self.job_dir, 'investigate_outliers.xlsx'), high_data, outliers, lower_limit, upper_limit
+        )
         return data
 
+    def __split_metadata(self, data: pd.DataFrame) -> tuple:
+        """Split data to analyse and metadata"""
+        return data.drop(self.metadata, axis=1, errors='ignore'), data[self.metadata]
+
     def feature_wiz(self, data: pd.DataFrame) -> pd.DataFrame:
         """Use feature_wiz to select features"""
         from featurewiz import FeatureWiz
@@ -195,16 +172,202 @@ class AnalyseVariables:
         return selected_features.join(y_train)
 
 
-def highlight(df: pd.DataFrame, lower_limit: np.array, upper_limit: np.array):
-    """Highlight outliers in a dataframe"""
-    style_df = pd.DataFrame('', index=df.index, columns=df.columns)
-    mask = pd.concat(
-        [~df.iloc[:, i].between(lower_limit[i], upper_limit[i], inclusive='neither') for i in range(lower_limit.size)],
-        axis=1,
+def outlier_bounds(values: np.ndarray, whiskers: float = 1.5) -> tuple:
+    """Lower and upper limit of each column, whiskers determines their reach (1.5 is the matplotlib default)"""
+    q1, q3 = np.nanpercentile(values, [25, 75], axis=0)
+    iqr = q3 - q1
+    return q1 - whiskers * iqr, q3 + whiskers * iqr
+
+
+def outlier_mask(values: np.ndarray, lower_limit: np.ndarray, upper_limit: np.ndarray) -> np.ndarray:
+    """Boolean mask of values on or beyond the limits of their column, missing values are no outliers"""
+    return (values <= lower_limit) | (values >= upper_limit)
+
+
+def outlier_table(data: pd.DataFrame, mask: np.ndarray, lower_limit: np.ndarray, upper_limit: np.ndarray):
+    """Outliers in long format, one row per subject and feature with the exceeded limit"""
+    rows, cols = np.nonzero(mask)
+    values = data.to_numpy(dtype=np.float64)[rows, cols]
+    return pd.DataFrame(
+        {
+            'subject': data.index[rows],
+            'feature': data.columns[cols],
+            'value': values,
+            'bound': np.where(values <= lower_limit[cols], lower_limit[cols], upper_limit[cols]),
+        }
     )
-    style_df = style_df.mask(mask, 'background-color: red')
-    style_df.iloc[:, lower_limit.size :] = ''  # uncolor metadata
-    return style_df
+
+
+def write_highlighted_outliers(
+    path: str, data: pd.DataFrame, outliers: pd.DataFrame, lower_limit: np.ndarray, upper_limit: np.ndarray
+) -> None:
+    """Write data with outliers highlighted by one conditional format rule per feature, and the outlier table
+
+    The first len(lower_limit) columns of data are the features the limits belong to, the rest is metadata.
+    """
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        data.to_excel(writer, sheet_name='data', index=True)
+        outliers.to_excel(writer, sheet_name='outliers', index=False)
+        worksheet = writer.sheets['data']
+        red = writer.book.add_format({'bg_color': 'red'})
+        n_rows = len(data.index)
+        for i, (lower, upper) in enumerate(zip(lower_limit, upper_limit)):
+            if np.isnan(lower) or np.isnan(upper):
+                continue
+            col = i + data.index.nlevels  # index columns come first
+            cell = xl_rowcol_to_cell(1, col)
+            worksheet.conditional_format(
+                1,
+                col,
+                n_rows,
+                col,
+                {
+                    'type': 'formula',
+                    'criteria': f'=AND(ISNUMBER({cell}),OR({cell}<={float(lower)!r},{cell}>={float(upper)!r}))',
+                    'format': red,
+                },
+            )
+
+
+def prune_correlated(matrix: np.ndarray, thresh: float) -> np.ndarray:
+    """Greedily keep features in the given (importance) order, dropping those correlated above thresh with a kept one
+
+    Returns a boolean mask of kept features in the order of the square correlation matrix.
+    """
+    high = np.triu(np.abs(matrix) > thresh, k=1)  # NaN correlations (constant features) never exceed thresh
+    keep = np.ones(len(matrix), dtype=bool)
+    for i in range(len(matrix)):
+        if keep[i]:
+            keep[i + 1 :] &= ~high[i, i + 1 :]
+    return keep
+
+
+def feature_importances(estimator) -> np.ndarray:
+    """Importances of a fitted estimator, some estimators return feature_importances_ attribute, others coef_"""
+    try:
+        return estimator.feature_importances_
+    except AttributeError:
+        return np.abs(np.squeeze(estimator.coef_))
+
+
+def rfe_feature_counts(n_features: int, step, min_features: int = 1) -> np.ndarray:
+    """Number of features at each RFE level in ascending order, as eliminated by sklearn's RFE"""
+    step = int(max(1, step * n_features)) if 0.0 < step < 1.0 else int(step)
+    counts = [n_features]
+    while counts[-1] > min_features:
+        counts.append(counts[-1] - min(step, counts[-1] - min_features))
+    return np.array(counts[::-1])
+
+
+def fit_fold(estimator, X: pd.DataFrame, y: pd.Series, train, test, features: np.ndarray, scorer) -> tuple:
+    """Fit on the training fold with the given features, returns test fold score and feature importances"""
+    estimator = clone(estimator).fit(X.iloc[train, features], y.iloc[train])
+    return scorer(estimator, X.iloc[test, features], y.iloc[test]), feature_importances(estimator)
+
+
+def early_stop_rfe(X: pd.DataFrame, y: pd.Series, estimator, cv, scoring, step, tol: float, n_jobs) -> tuple:
+    """RFECV that stops once the CV score drops more than tol below the best score seen so far
+
+    As in RFECV, features are eliminated within each fold by the importances of the estimator fitted on its
+    training split, the feature counts follow the same schedule.
+    """
+    scorer = check_scoring(estimator, scoring=scoring)
+    folds = list(cv.split(X, y))
+    counts = rfe_feature_counts(X.shape[1], step)[::-1]  # descending
+    fold_features = [np.arange(X.shape[1]) for _ in folds]
+    best_score, best_count = -np.inf, counts[0]
+    means, stds = [], []
+    fits = 0
+    for level, count in enumerate(counts):
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(fit_fold)(estimator, X, y, train, test, features, scorer)
+            for (train, test), features in zip(folds, fold_features)
+        )
+        fits += len(folds)
+        scores = np.array([score for score, _ in results])
+        means.append(scores.mean())
+        stds.append(scores.std())
+        if means[-1] > best_score:
+            best_score, best_count = means[-1], count
+        elif means[-1] < best_score - tol:
+            logger.info(f'Early stop of RFE at {count} features, CV score dropped below {best_score - tol:.4f}')
+            break
+        if level + 1 < len(counts):  # drop least important features of each fold, keep order
+            n_remove = count - counts[level + 1]
+            fold_features = [
+                features[np.sort(np.argsort(importances)[n_remove:])]
+                for features, (_, importances) in zip(fold_features, results)
+            ]
+
+    selector = RFE(estimator, n_features_to_select=int(best_count), step=step).fit(X, y)  # on all data, as RFECV
+    fits += int(np.sum(counts >= best_count))  # elimination levels and final estimator
+    cv_results = {  # ascending number of features, as in RFECV
+        'n_features': counts[: len(means)][::-1],
+        'mean_test_score': np.array(means[::-1]),
+        'std_test_score': np.array(stds[::-1]),
+    }
+    return selector.support_, cv_results, selector.estimator_, fits
+
+
+def fit_rfe(
+    data: pd.DataFrame,
+    target_label: str,
+    rfe_estimator: str,
+    task: str,
+    seed,
+    scoring,
+    class_weight,
+    n_jobs,
+    step=1,
+    max_features: int = None,
+    early_stop_tol: float = None,
+) -> tuple:
+    """Fit RFECV for one estimator, returns support mask, cv results, importances and fit statistics"""
+    start = time.perf_counter()
+    estimator, cross_validator, scoring = init_estimator(
+        rfe_estimator, task, seed, scoring, class_weight, n_jobs=1
+    )  # RFECV parallelises over folds, avoid nested parallelism
+
+    X = data.drop(target_label, axis=1)
+    y = data[target_label]
+    candidates = np.arange(X.shape[1])
+    fits = 0
+
+    if max_features is not None and X.shape[1] > max_features:  # pre-select by importance of a single fit
+        importances = feature_importances(clone(estimator).fit(X, y))
+        fits += 1
+        candidates = np.sort(np.argsort(importances)[::-1][:max_features])
+
+    if early_stop_tol is None:
+        selector = RFECV(
+            estimator=estimator,
+            step=step,
+            min_features_to_select=1,
+            cv=cross_validator,
+            scoring=scoring,
+            n_jobs=n_jobs,
+        )
+        # RFECV shares one RFE between its folds, which is not thread-safe, but joblib nests threads inside workers
+        with parallel_backend('loky'):
+            selector.fit(X.iloc[:, candidates], y)
+        cv_results = {**selector.cv_results_, 'n_features': rfe_feature_counts(len(candidates), step)}
+        n_levels_final = int(np.sum(cv_results['n_features'] >= selector.n_features_))
+        n_levels = len(cv_results['n_features'])
+        fits += n_levels * cross_validator.get_n_splits() + n_levels_final + 1  # folds, final RFE, final estimator
+        support, fitted = selector.support_, selector.estimator_
+    else:
+        support, cv_results, fitted, n_fits = early_stop_rfe(
+            X.iloc[:, candidates], y, estimator, cross_validator, scoring, step, early_stop_tol, n_jobs
+        )
+        fits += n_fits
+
+    if not hasattr(fitted, 'feature_importances_'):
+        logger.warning(f'Note that absolute coefficient values do not necessarily represent feature importances.')
+    full_support = np.zeros(X.shape[1], dtype=bool)
+    full_support[candidates[support]] = True
+    stats = {'fits': fits, 'wall_time': time.perf_counter() - start}
+
+    return full_support, cv_results, feature_importances(fitted), stats
 
 
 class FeatureReduction:
@@ -220,52 +383,45 @@ class FeatureReduction:
         self.scoring = None
         self.class_weight = None
         self.task = None
+        self.n_jobs = None
+        self.plotter = plots.Plotter()
+        self.fr_all_estimators = ['forest', 'xgboost', 'adaboost', 'extreme_forest']
+        self.rfe_step = 1
+        self.rfe_max_features = None
+        self.rfe_early_stop_tol = None
+
+    def rfe_args(self, n_jobs) -> tuple:
+        """Arguments of fit_rfe after the estimator name"""
+        return (
+            self.task,
+            self.seed,
+            self.scoring,
+            self.class_weight,
+            n_jobs,
+            self.rfe_step,
+            self.rfe_max_features,
+            self.rfe_early_stop_tol,
+        )
 
     def __reduction(self, data: pd.DataFrame, rfe_estimator: str) -> (pd.DataFrame, pd.DataFrame):
-        estimator, cross_validator, scoring = init_estimator(
-            rfe_estimator, self.task, self.seed, self.scoring, self.class_weight
-        )
+        results = fit_rfe(data, self.target_label, rfe_estimator, *self.rfe_args(self.n_jobs))
+        return self.__report_reduction(data, rfe_estimator, *results)
 
+    def __report_reduction(
+        self, data: pd.DataFrame, rfe_estimator: str, support, cv_results: dict, importances, stats: dict
+    ) -> (pd.DataFrame, pd.DataFrame):
+        """Plot RFECV results and importances, keep selected features"""
         number_of_top_features = 30
         X = data.drop(self.target_label, axis=1)
-        y = data[self.target_label]
-
-        min_features = 1
-
-        selector = RFECV(
-            estimator=estimator,
-            min_features_to_select=min_features,
-            cv=cross_validator,
-            scoring=scoring,
-            n_jobs=4,
-        )
-        selector.fit(X, y)
-
-        # Plot performance for increasing number of features
-        n_scores = len(selector.cv_results_['mean_test_score'])
-        fig = plt.figure()
-        plt.xlabel('Number of features selected')
-        plt.ylabel(f'Mean {self.scoring}')
-        plt.xticks(range(0, n_scores + 1, 5))
-        plt.grid(alpha=0.5)
-        plt.errorbar(
-            range(min_features, n_scores + min_features),
-            selector.cv_results_['mean_test_score'],
-            yerr=selector.cv_results_['std_test_score'],
-        )
-        plt.title(f'Recursive Feature Elimination for {rfe_estimator} estimator')
-        plt.savefig(os.path.join(self.job_dir, f'RFECV_{rfe_estimator}.pdf'))
-        plt.close(fig)
+        logger.info(f'RFE with {rfe_estimator} estimator: {stats["fits"]} fits in {stats["wall_time"]:.1f}s')
+        with open(os.path.join(self.job_dir, f'RFECV_{rfe_estimator}.json'), 'w') as file:
+            json.dump({**stats, 'n_features_selected': int(np.sum(support))}, file, indent=2)
 
-        data = pd.concat((X.loc[:, selector.support_], data[self.target_label]), axis=1)  # concat with target label
+        self.plotter.submit(plots.rfecv_curve, self.job_dir, rfe_estimator, cv_results, self.scoring, essential=True)
 
-        try:  # some estimators return feature_importances_ attribute, others coef_
-            importances = selector.estimator_.feature_importances_
-        except AttributeError:
-            logger.warning(f'Note that absolute coefficient values do not necessarily represent feature importances.')
-            importances = np.abs(np.squeeze(selector.estimator_.coef_))
+        data = pd.concat((X.loc[:, support], data[self.target_label]), axis=1)  # concat with target label
 
-        importances = pd.DataFrame(importances, index=X.columns[selector.support_], columns=['importance'])
+        importances = pd.DataFrame(importances, index=X.columns[support], columns=['importance'])
         importances = importances.sort_values(by='importance', ascending=True)
         importances = importances.iloc[
             -number_of_top_features:, :
@@ -276,17 +432,9 @@ class FeatureReduction:
             f'number of remaining features: {len(data.columns) - 1}'
         )
 
-        # plot importances as bar chart
-        ax = importances.plot.barh()
-        fig = ax.get_figure()
-        plt.title(
-            f'Feature importance (top {number_of_top_features})'
-            f'\n{rfe_estimator} estimator for target: {self.target_label}'
+        self.plotter.submit(
+            plots.importance_bars, self.job_dir, rfe_estimator, importances, self.target_label, essential=True
         )
-        plt.tight_layout()
-        plt.gca().legend_.remove()
-        plt.savefig(os.path.join(self.job_dir, f'feature_importance_{rfe_estimator}.pdf'), dpi=fig.dpi)
-        plt.close(fig)
 
         return data, importances.index.tolist()[::-1]
 
@@ -317,58 +465,46 @@ class FeatureReduction:
 
     def fr_all(self, data: pd.DataFrame) -> pd.DataFrame:
         """Feature reduction using all estimators in an ensemble manner"""
-        number_of_estimators = 4
-        _, f_features = self.__reduction(data, 'forest')
-        _, xg_features = self.__reduction(data, 'xgboost')
-        _, ada_features = self.__reduction(data, 'adaboost')
-        _, ef_features = self.__reduction(data, 'extreme_forest')
-
-        min_len = min(
-            len(f_features),
-            len(xg_features),
-            len(ada_features),
-            len(ef_features),
-        )  # take the minimum length
+        estimators = list(self.fr_all_estimators)
+        number_of_estimators = len(estimators)
+        n_jobs = max(1, (self.n_jobs or 1) // number_of_estimators)  # share cpu budget between estimators
+        args = self.rfe_args(n_jobs)
+        results = Parallel(n_jobs=min(number_of_estimators, self.n_jobs or 1))(  # RFECV runs concurrently
+            delayed(fit_rfe)(data, self.target_label, estimator, *args) for estimator in estimators
+        )  # plots afterwards
+
+        all_features = {}
+        for estimator, result in zip(estimators, results):
+            _, all_features[estimator] = self.__report_reduction(data, estimator, *result)
+
+        min_len = min(len(features) for features in all_features.values())  # take the minimum length
         if min_len >= 10:
             min_len = 10
 
-        sub_f_features = f_features[:min_len]  # take the top features
-        sub_xg_features = xg_features[:min_len]
-        sub_ada_features = ada_features[:min_len]
-        sub_ef_features = ef_features[:min_len]
-
-        f_features = {f: i for i, f in enumerate(sub_f_features[::-1], start=1)}  # reverse the order and assign weights
-        xg_features = {f: i for i, f in enumerate(sub_xg_features[::-1], start=1)}
-        ada_features = {f: i for i, f in enumerate(sub_ada_features[::-1], start=1)}
-        ef_features = {f: i for i, f in enumerate(sub_ef_features[::-1], start=1)}
+        weights = {}
+        for estimator, features in all_features.items():
+            sub_features = features[:min_len]  # take the top features
+            weights[estimator] = {f: i for i, f in enumerate(sub_features[::-1], start=1)}  # reverse and weigh
 
-        all_keys = set(f_features.keys()).union(xg_features.keys()).union(ada_features.keys()).union(ef_features.keys())
+        all_keys = set().union(*[w.keys() for w in weights.values()])
         feature_scores = pd.DataFrame(all_keys, columns=['feature'])
-        feature_scores['forest'] = feature_scores['feature'].apply(lambda key: f_features.get(key))
-        feature_scores['xgboost'] = feature_scores['feature'].apply(lambda key: xg_features.get(key))
-        feature_scores['adaboost'] = feature_scores['feature'].apply(lambda key: ada_features.get(key))
-        feature_scores['extreme_forest'] = feature_scores['feature'].apply(lambda key: ef_features.get(key))
+        for estimator in estimators:
+            feature_scores[estimator] = feature_scores['feature'].map(weights[estimator])
         feature_scores = feature_scores.fillna(0)  # non-selected features get score of 0
         feature_scores['all'] = feature_scores.iloc[:, 1:].sum(axis=1)
         feature_scores = feature_scores.sort_values(by='all', ascending=True)
 
-        ax = feature_scores.plot(
-            x='feature',
-            y=['forest', 'xgboost', 'adaboost', 'extreme_forest'],
-            kind='barh',
-            stacked=True,
-            colormap='viridis',
+        self.plotter.submit(
+            plots.stacked_importances,
+            self.job_dir,
+            feature_scores,
+            estimators,
+            self.target_label,
+            number_of_estimators * min_len,
+            essential=True,
         )
-        fig = ax.get_figure()
-        fig.legend(loc='lower right', borderaxespad=4.5)
-        plt.title(f'Feature importance\nAll estimators for target: {self.target_label}')
-        plt.xlabel(f'Summed importance (max {number_of_estimators*min_len})')
-        plt.tight_layout()
-        plt.gca().legend_.remove()
-        plt.savefig(os.path.join(self.job_dir, 'feature_importance_all.pdf'), dpi=fig.dpi)
-        plt.close(fig)
 
         logger.info(f'Top features: {list(feature_scores["feature"])}')
-        features_to_keep = list(feature_scores["feature"]) + list(self.target_label)
-        data = data.drop(columns=[c for c in data.columns if c not in features_to_keep], axis=1)
+        features_to_keep = list(feature_scores["feature"]) + [self.target_label]
+        data = data.drop(columns=[c for c in data.columns if c not in features_to_keep])
         return data, feature_scores['feature'].tolist()[::-1]
@@ -3,7 +3,9 @@ from sklearn.model_selection import GridSearchCV
 
 
 class CrossValidation:
-    def __init__(self, x_train, y_train, estimator, cross_validator, param_grid: dict, scoring: str, seed: int) -> None:
+    def __init__(
+        self, x_train, y_train, estimator, cross_validator, param_grid: dict, scoring: str, seed: int, n_jobs: int = 4
+    ) -> None:
         self.x_train = x_train
         self.y_train = y_train
         self.estimator = estimator
@@ -11,6 +13,7 @@ class CrossValidation:
         self.param_grid = dict(param_grid)
         self.scoring = scoring
         self.seed = seed
+        self.n_jobs = n_jobs
 
     def __call__(self):
         selector = GridSearchCV(
@@ -18,7 +21,7 @@ class CrossValidation:
             param_grid=self.param_grid,
             scoring=self.scoring,
             cv=self.cross_validator,
-            n_jobs=4,
+            n_jobs=self.n_jobs,
         )
         selector.fit(self.x_train, self.y_train)
 
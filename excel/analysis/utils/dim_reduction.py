@@ -1,14 +1,13 @@
 """Dimensionality reduction module
 """
 
-import os
-
 import pandas as pd
-import plotly.express as px
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from umap import UMAP
 
+from excel.analysis.utils import plots
+
 
 def plot_bubble(func):
     def wrapper(self, *args):
@@ -18,28 +17,7 @@ def plot_bubble(func):
 
         proj_2d, proj_3d, name = func(self, x_train)  # call the wrapped function
 
-        fig_2d = px.scatter(
-            proj_2d,
-            x=0,
-            y=1,
-            color=y_train,
-            labels={'color': self.target_label},
-            title=f'{name} 2D',
-        )
-        fig_3d = px.scatter_3d(
-            proj_3d,
-            x=0,
-            y=1,
-            z=2,
-            color=y_train,
-            labels={'color': self.target_label},
-            title=f'{name} 3D',
-        )
-        fig_3d.update_traces(marker_size=5)
-
-        fig_2d.write_image(os.path.join(self.job_dir, f'{name}_2d.svg'))
-        fig_2d.write_html(os.path.join(self.job_dir, f'{name}_2d.html'))
-        fig_3d.write_html(os.path.join(self.job_dir, f'{name}_3d.html'))
+        self.plotter.submit(plots.bubble_plots, self.job_dir, name, proj_2d, proj_3d, y_train.copy(), self.target_label)
 
         return data
 
@@ -52,6 +30,8 @@ class DimensionReductions:
         self.metadata = None
         self.seed = None
         self.target_label = None
+        self.n_jobs = None
+        self.plotter = plots.Plotter()
 
     @plot_bubble
     def pca(self, data: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame, str):
@@ -65,8 +45,8 @@ class DimensionReductions:
     @plot_bubble
     def tsne(self, data: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame, str):
         """Perform t-SNE dimensionality reduction and visualisation"""
-        tsne_2d = TSNE(n_components=2, random_state=self.seed)
-        tsne_3d = TSNE(n_components=3, random_state=self.seed)
+        tsne_2d = TSNE(n_components=2, random_state=self.seed, n_jobs=self.n_jobs)
+        tsne_3d = TSNE(n_components=3, random_state=self.seed, n_jobs=self.n_jobs)
         proj_2d = tsne_2d.fit_transform(data)
         proj_3d = tsne_3d.fit_transform(data)
         return proj_2d, proj_3d, 't-SNE'
@@ -74,8 +54,9 @@ class DimensionReductions:
     @plot_bubble
     def umap(self, data: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame, str):
         """Perform UMAP dimensionality reduction and visualisation"""
-        umap_2d = UMAP(n_components=2, random_state=self.seed)
-        umap_3d = UMAP(n_components=3, random_state=self.seed)
+        n_jobs = 1 if self.seed is not None else self.n_jobs  # seeded UMAP is single-threaded for reproducibility
+        umap_2d = UMAP(n_components=2, random_state=self.seed, n_jobs=n_jobs)
+        umap_3d = UMAP(n_components=3, random_state=self.seed, n_jobs=n_jobs)
         proj_2d = umap_2d.fit_transform(data)
         proj_3d = umap_3d.fit_transform(data)
         return proj_2d, proj_3d, 'UMAP'
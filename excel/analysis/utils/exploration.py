@@ -2,19 +2,23 @@
 """
 
 import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
+from threadpoolctl import threadpool_limits
 from excel.analysis.utils.dim_reduction import DimensionReductions
-from excel.analysis.utils.helpers import variance_threshold
+from excel.analysis.utils.helpers import cpu_budget, variance_threshold
 from excel.analysis.utils.normalisers import Normaliser
+from excel.analysis.utils.plots import Plotter
 from excel.analysis.utils.analyse_variables import AnalyseVariables, FeatureReduction
 
 
 
 class ExploreData(Normaliser, DimensionReductions, AnalyseVariables, FeatureReduction):
-    def __init__(self, config: DictConfig, data: pd.DataFrame, task: str) -> None:
+    def __init__(self, config: DictConfig, data: pd.DataFrame, task: str, plotter: Plotter = None) -> None:
         super().__init__()
         self.original_data = data
         self.out_dir = os.path.join(config.dataset.out_dir, '6_exploration', config.analysis.experiment.name)
@@ -24,39 +28,91 @@ class ExploreData(Normaliser, DimensionReductions, AnalyseVariables, FeatureRedu
         self.corr_method = config.analysis.run.corr_method
         self.corr_thresh = config.analysis.run.corr_thresh
         self.corr_drop_features = config.analysis.run.corr_drop_features
+        self.corr_importance = config.analysis.run.get('corr_importance', 'permutation')
+        self.corr_n_repeats = config.analysis.run.get('corr_n_repeats', 5)
         self.metadata = config.analysis.experiment.metadata
         self.target_label = config.analysis.experiment.target_label
         self.auto_norm_method = config.analysis.run.auto_norm_method
         self.scoring = config.analysis.run.scoring
         self.class_weight = config.analysis.run.class_weight
         self.task = task
+        self.parallel_jobs = config.analysis.run.get('parallel_jobs', 1)  # number of jobs run concurrently
+        # share the cpu budget between concurrent jobs and the inner n_jobs of estimators, selectors and searches
+        self.n_jobs = cpu_budget(config.analysis.run.get('n_jobs', -1), self.parallel_jobs)
+        self.threads_per_job = config.analysis.run.get('threads_per_job', 1)  # BLAS threads per worker
+        self.fr_all_estimators = config.analysis.run.get(
+            'fr_all_estimators', ['forest', 'xgboost', 'adaboost', 'extreme_forest']
+        )
+        rfe = config.analysis.run.get('rfe', {})
+        self.rfe_step = rfe.get('step', 1)
+        self.rfe_max_features = rfe.get('max_features', None)
+        self.rfe_early_stop_tol = rfe.get('early_stop_tol', None)
+
+        # plots are rendered in place unless a background plotter is passed, whose owner waits for them
+        self.plotter = plotter or Plotter(config.analysis.run.get('plots', 'all'))
 
         self.job_name = ''
+        self.job_features = []  # selected features per job, in job order
 
     def __call__(self) -> pd.DataFrame:
         """Run all jobs"""
         self.__check_jobs()
         self.__check_auto_norm_methods()
-        for job in self.jobs:
-            logger.info(f'Running {job}')
-            self.job_name = '_'.join(job)  # name of current job
-            self.job_dir = os.path.join(self.out_dir, self.job_name)
-            os.makedirs(self.job_dir, exist_ok=True)
-            data = deepcopy(self.original_data)
-            for step in job:
+        if self.parallel_jobs > 1:  # independent jobs in separate processes, shared prefixes are not reused
+            logger.info(f'Running {len(self.jobs)} jobs on {self.parallel_jobs} processes with n_jobs={self.n_jobs}')
+            with ProcessPoolExecutor(max_workers=self.parallel_jobs) as executor:
+                results = list(executor.map(self.run_job, self.jobs))  # map keeps the job order
+        else:
+            # number of jobs sharing each step prefix, shared prefixes are computed once and reused
+            prefix_uses = Counter(tuple(job[:i]) for job in self.jobs for i in range(1, len(job) + 1))
+            cache = {}
+            results = []
+            for job in self.jobs:
+                results.append(self.run_job(job, cache, prefix_uses))
+                for i in range(1, len(job) + 1):  # release prefixes no remaining job needs
+                    prefix_uses[tuple(job[:i])] -= 1
+                    if prefix_uses[tuple(job[:i])] == 0:
+                        cache.pop(tuple(job[:i]), None)
+
+        self.job_features = [self.__features(data) for data in results]
+        return self.job_features[-1]
+
+    def run_job(self, job: list, cache: dict = None, prefix_uses: Counter = None):
+        """Run the steps of one job, starting from the longest cached prefix if available"""
+        logger.info(f'Running {job}')
+        self.job_name = '_'.join(job)  # name of current job
+        self.job_dir = os.path.join(self.out_dir, self.job_name)
+        os.makedirs(self.job_dir, exist_ok=True)
+        cache = {} if cache is None else cache
+        start, data = 0, self.original_data
+        for i in range(len(job), 0, -1):  # longest cached prefix
+            if tuple(job[:i]) in cache:
+                start, data = i, cache[tuple(job[:i])]
+                logger.info(f'Cache hit, reusing result of {job[:i]} (plots of these steps are in a previous job)')
+                break
+        data = deepcopy(data)  # steps may modify data in place
+        with threadpool_limits(limits=self.threads_per_job):
+            for i, step in enumerate(job[start:], start=start + 1):
                 data, error = self.process_job(step, data)
                 if error:
                     logger.error(f'Step {step} is invalid')
                     break
-        
-        if isinstance(data, tuple): # return features
+                if prefix_uses is not None and prefix_uses[tuple(job[:i])] > 1 and tuple(job[:i]) not in cache:
+                    cache[tuple(job[:i])] = deepcopy(data)
+        return data
+
+    @staticmethod
+    def __features(data):
+        """Features returned by a job"""
+        if data is None:
+            return None
+        if isinstance(data, tuple):  # return features
             return data[1]
-        else:
-            return data.columns
+        return data.columns
 
     def __check_jobs(self) -> None:
         """Check if the given jobs are valid"""
-        valid_methods = set([x for x in dir(self) if not x.startswith('_') and x != 'process_job'])
+        valid_methods = set([x for x in dir(self) if not x.startswith('_') and x not in ['process_job', 'run_job']])
         jobs = set([x for sublist in self.jobs for x in sublist])
         if not jobs.issubset(valid_methods):
             raise ValueError(f'Invalide job, check -> {str(jobs - valid_methods)}')
@@ -1,6 +1,7 @@
 import os
 from copy import deepcopy
 
+import numpy as np
 import pandas as pd
 from loguru import logger
 from sklearn.ensemble import (
@@ -70,12 +71,76 @@ def variance_threshold(data: pd.DataFrame, label: str, thresh: float) -> pd.Data
     return data
 
 
-def init_estimator(estimator_name: str, task: str, seed, scoring, class_weight):
+def correlation_matrix(data: pd.DataFrame, method: str = 'pearson', block_size: int = 2048) -> pd.DataFrame:
+    """Correlation matrix of all columns, equivalent to data.corr(method) for pearson and spearman
+
+    Pearson is a single matrix product of the standardised data, spearman ranks each column once first.
+    Wide data is processed in blocks of block_size columns. Data with missing values and other methods
+    are passed on to pandas, which uses pairwise complete observations.
+    """
+    if method not in ['pearson', 'spearman'] or data.isna().to_numpy().any():
+        return data.corr(method=method)
+
+    values = data.rank().to_numpy(dtype=np.float64) if method == 'spearman' else data.to_numpy(dtype=np.float64)
+    values = values - values.mean(axis=0)
+    norms = np.linalg.norm(values, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = values / norms  # constant columns have undefined correlation, as in pandas
+
+    n_columns = values.shape[1]
+    matrix = np.empty((n_columns, n_columns))
+    for start in range(0, n_columns, block_size):
+        matrix[start : start + block_size] = values[:, start : start + block_size].T @ values
+    np.clip(matrix, -1, 1, out=matrix)
+    matrix[np.diag_indices(n_columns)] = np.where(norms > 0, 1.0, np.nan)
+
+    return pd.DataFrame(matrix, index=data.columns, columns=data.columns)
+
+
+def feature_values(data: pd.DataFrame, label: str = None) -> tuple:
+    """Feature columns without the label and their values as one float32 (if all features are) or float64 array
+
+    The values come from a single to_numpy of the frame, which is a view if the frame is one block of that dtype.
+    The label is sliced out positionally, as a view if it is the first or last column and as a copy otherwise.
+    """
+    columns = data.columns
+    features = columns.drop(label) if label in columns else columns
+    dtype = np.float32 if len(features) and (data.dtypes[features] == np.float32).all() else np.float64
+    values = data.to_numpy(dtype=dtype, copy=False)
+    if label in columns:
+        position = columns.get_loc(label)
+        if position == 0:
+            values = values[:, 1:]
+        elif position == len(columns) - 1:
+            values = values[:, :-1]
+        else:
+            values = np.delete(values, position, axis=1)
+    return features, values
+
+
+def to_frame(values, index: pd.Index, columns: pd.Index) -> pd.DataFrame:
+    """Wrap transformed values with index and columns, without copying
+
+    Transformers with set_output(transform='pandas') already return a frame, which is only relabelled.
+    """
+    if isinstance(values, pd.DataFrame):
+        values.index, values.columns = index, columns
+        return values
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def cpu_budget(n_jobs: int, parallel: int = 1) -> int:
+    """Number of workers for each of parallel concurrent units, given the total budget n_jobs (-1 uses all cores)"""
+    total = (os.cpu_count() or 1) if n_jobs is None or n_jobs < 0 else n_jobs
+    return max(1, total // max(1, parallel))
+
+
+def init_estimator(estimator_name: str, task: str, seed, scoring, class_weight, n_jobs: int = None):
     if task == 'classification':
         if estimator_name == 'forest':
-            estimator = RandomForestClassifier(random_state=seed, class_weight=class_weight)
+            estimator = RandomForestClassifier(random_state=seed, class_weight=class_weight, n_jobs=n_jobs)
         elif estimator_name == 'extreme_forest':
-            estimator = ExtraTreesClassifier(random_state=seed, class_weight=class_weight)
+            estimator = ExtraTreesClassifier(random_state=seed, class_weight=class_weight, n_jobs=n_jobs)
         elif estimator_name == 'adaboost':
             estimator = AdaBoostClassifier(random_state=seed)
         elif estimator_name == 'logistic_regression':
@@ -89,9 +154,9 @@ def init_estimator(estimator_name: str, task: str, seed, scoring, class_weight):
 
     else:  # regression
         if estimator_name == 'forest':
-            estimator = RandomForestRegressor(random_state=seed)
+            estimator = RandomForestRegressor(random_state=seed, n_jobs=n_jobs)
         elif estimator_name == 'extreme_forest':
-            estimator = ExtraTreesRegressor(random_state=seed)
+            estimator = ExtraTreesRegressor(random_state=seed, n_jobs=n_jobs)
         elif estimator_name == 'adaboost':
             estimator = AdaBoostRegressor(random_state=seed)
         elif estimator_name == 'logistic_regression':
@@ -1,28 +1,134 @@
+import time
+import warnings
+
 import numpy as np
 import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.ensemble import ExtraTreesRegressor
 from sklearn.experimental import enable_iterative_imputer  # because of bug in sklearn
 from sklearn.impute import IterativeImputer, KNNImputer, MissingIndicator, SimpleImputer
+from sklearn.linear_model import BayesianRidge
+from sklearn.neighbors import KNeighborsRegressor, NearestNeighbors
+from sklearn.preprocessing import StandardScaler
+
+from excel.analysis.utils.helpers import feature_values, to_frame
 
 
 def data_bubble(func):
     def wrapper(self, *args):
         data = args[0]
         impute = func(self)
-        imp_data = impute.fit_transform(data)
-        imp_data = pd.DataFrame(imp_data, index=data.index, columns=data.columns)
+        features, values = feature_values(data, self.target_label)  # keep label col as is
+        start = time.perf_counter()
+        imp_data = to_frame(impute.fit_transform(values), data.index, features)
+        report = f'{self.impute_method} imputed {np.isnan(values).sum()} values in {time.perf_counter() - start:.1f}s'
+        if hasattr(impute, 'n_iter_'):
+            converged = 'converged' if impute.n_iter_ < self.max_iter else 'did not converge'
+            report += f', {converged} after {impute.n_iter_} iterations'
+        logger.info(report)
+        if self.target_label in data.columns:
+            imp_data.insert(data.columns.get_loc(self.target_label), self.target_label, data[self.target_label])
         logger.info(f'{self.impute_method} reduced features from {len(data)} -> {len(imp_data)}')
         return imp_data
 
     return wrapper
 
 
+class BlockImputer(BaseEstimator, TransformerMixin):
+    """Impute blocks of block_size incomplete columns independently with clones of imputer (fit_transform only)
+
+    Each block is imputed together with the max_predictors complete columns most correlated with it, which
+    serve as predictors only. Cost grows linearly with the number of columns, at the price of ignoring
+    relations between blocks.
+    """
+
+    def __init__(self, imputer, block_size: int = 100, max_predictors: int = 50) -> None:
+        self.imputer = imputer
+        self.block_size = block_size
+        self.max_predictors = max_predictors
+
+    def fit_transform(self, X, y=None):
+        X = np.array(X, dtype=np.float64)
+        missing = np.isnan(X).any(axis=0)
+        incomplete, complete = np.flatnonzero(missing), np.flatnonzero(~missing)
+        standardised = standardise(X[:, complete])
+        self.n_iter_ = 0
+        for start in range(0, len(incomplete), self.block_size):
+            block = incomplete[start : start + self.block_size]
+            predictors = self.__predictors(X[:, block], complete, standardised)
+            imputer = clone(self.imputer)
+            X[:, block] = imputer.fit_transform(X[:, np.concatenate((block, predictors))])[:, : len(block)]
+            self.n_iter_ = max(self.n_iter_, getattr(imputer, 'n_iter_', 0))
+        return X
+
+    def __predictors(self, block_values: np.ndarray, complete: np.ndarray, standardised: np.ndarray) -> np.ndarray:
+        """Complete columns with the highest absolute correlation to any column of the block"""
+        if len(complete) <= self.max_predictors:
+            return complete
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # empty columns
+            block_means = np.nan_to_num(np.nanmean(block_values, axis=0))  # mean filled, only to rank the predictors
+        block_values = standardise(np.where(np.isnan(block_values), block_means, block_values))
+        correlation = np.abs(block_values.T @ standardised).max(axis=0)
+        return np.sort(complete[np.argsort(-correlation, kind='stable')[: self.max_predictors]])
+
+
+def standardise(values: np.ndarray) -> np.ndarray:
+    """Columns with zero mean and unit norm, constant columns become zero"""
+    values = values - values.mean(axis=0)
+    norms = np.linalg.norm(values, axis=0)
+    return np.divide(values, norms, out=np.zeros_like(values), where=norms > 0)
+
+
+class SubspaceKNNImputer(BaseEstimator, TransformerMixin):
+    """Impute with the mean of the nearest neighbours in the standardised complete columns (fit_transform only)
+
+    Neighbours come from a single index over the columns without missing values, instead of brute-force
+    nan-aware distances to every subject. Falls back to KNNImputer if no column is complete.
+    """
+
+    def __init__(self, n_neighbors: int = 5) -> None:
+        self.n_neighbors = n_neighbors
+
+    def fit_transform(self, X, y=None):
+        X = np.array(X, dtype=np.float64)
+        missing = np.isnan(X)
+        complete = ~missing.any(axis=0)
+        if not complete.any():
+            return KNNImputer(n_neighbors=self.n_neighbors, keep_empty_features=True).fit_transform(X)
+        rows = np.flatnonzero(missing.any(axis=1))
+        if rows.size == 0:
+            return X
+
+        subspace = StandardScaler().fit_transform(X[:, complete])
+        n_neighbors = min(self.n_neighbors + 1, len(X))  # subjects are their own nearest neighbour
+        index = NearestNeighbors(n_neighbors=n_neighbors).fit(subspace)
+        _, neighbours = index.kneighbors(subspace[rows])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # neighbours all missing a column
+            estimates = np.nanmean(X[neighbours[:, 1:]], axis=1)
+            column_means = np.nanmean(X, axis=0)
+        estimates = np.where(np.isnan(estimates), column_means, estimates)
+        X[rows] = np.where(missing[rows], estimates, X[rows])
+        return np.nan_to_num(X, nan=0.0, copy=False)  # empty features become zeros, as with keep_empty_features
+
+
 class Imputers:
     def __init__(self, config: DictConfig) -> None:
         self.config = config
         self.seed = config.analysis.run.seed
         self.impute_method = self.config.merge.impute
+        self.target_label = config.analysis.experiment.target_label
+        options = config.merge.get('imputation', {})
+        self.block_size = options.get('block_size', None)
+        self.max_predictors = options.get('max_predictors', 50)
+        self.estimator = options.get('estimator', 'bayesian_ridge')
+        self.max_iter = options.get('max_iter', 100)
+        self.tol = options.get('tol', 1e-3)
+        self.n_neighbors = options.get('n_neighbors', 5)
+        self.knn_subspace = options.get('knn_subspace', False)
 
     def __call__(self, data: pd.DataFrame) -> pd.DataFrame:
         """Impute missing data"""
@@ -50,13 +156,28 @@ class Imputers:
 
     @data_bubble
     def iterative_impute(self) -> IterativeImputer:
-        """Iterative impute"""
-        return IterativeImputer(
+        """Iterative impute, optionally in independent column blocks"""
+        imputer = IterativeImputer(
+            estimator=self.__iterative_estimator(),
             initial_strategy='median',
-            max_iter=100,
+            max_iter=self.max_iter,
+            tol=self.tol,
             random_state=self.seed,
             keep_empty_features=True,
         )
+        if self.block_size:
+            return BlockImputer(imputer, block_size=self.block_size, max_predictors=self.max_predictors)
+        return imputer
+
+    def __iterative_estimator(self):
+        """Estimator predicting each feature from the others in iterative imputation"""
+        if self.estimator == 'bayesian_ridge':
+            return BayesianRidge()
+        if self.estimator == 'forest':
+            return ExtraTreesRegressor(n_estimators=10, random_state=self.seed)
+        if self.estimator == 'knn':
+            return KNeighborsRegressor(n_neighbors=self.n_neighbors)
+        raise ValueError(f'Unknown iterative imputation estimator: {self.estimator}')
 
     @data_bubble
     def simple_impute(self) -> SimpleImputer:
@@ -76,8 +197,10 @@ class Imputers:
 
     @data_bubble
     def knn_impute(self) -> KNNImputer:
-        """KNN impute"""
+        """KNN impute, optionally with neighbours searched once on the complete columns"""
+        if self.knn_subspace:
+            return SubspaceKNNImputer(n_neighbors=self.n_neighbors)
         return KNNImputer(
-            n_neighbors=5,
+            n_neighbors=self.n_neighbors,
             keep_empty_features=True,
         )
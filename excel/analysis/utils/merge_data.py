@@ -1,12 +1,16 @@
 """Extracts data for desired experiment
 """
 
+import hashlib
+import json
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 from loguru import logger
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 from excel.analysis.utils.helpers import save_tables
 from excel.global_helpers import checked_dir
@@ -14,6 +18,20 @@ from excel.global_helpers import checked_dir
 # from sklearn.experimental import enable_iterative_imputer  # because of bug in sklearn
 # from sklearn.impute import IterativeImputer, MissingIndicator
 
+METADATA_CACHE_VERSION = 2  # bump when the conversion of the metadata workbook changes
+SEGMENT_ROWS = {'roi': ['global', 'endo', 'epi']}  # rows kept per segment type, one feature each
+
+
+def resample_curves(times: np.ndarray, values: np.ndarray, time_points: int) -> np.ndarray:
+    """Linearly interpolate all curves (rows of values) sampled at times onto a grid of the normalised cycle"""
+    if values.shape[1] < 2:
+        return np.full((values.shape[0], time_points), np.nan)
+    times = (times - times[0]) / (times[-1] - times[0])  # normalise cycle to [0, 1]
+    grid = np.linspace(0, 1, time_points)
+    right = np.clip(np.searchsorted(times, grid, side='right'), 1, len(times) - 1)
+    left = right - 1
+    weight = (grid - times[left]) / (times[right] - times[left])
+    return values[:, left] * (1 - weight) + values[:, right] * weight
 
 
 class MergeData:
@@ -28,6 +46,10 @@ class MergeData:
         self.dims = config.dataset.dims
         # self.impute = config.merge.impute
         self.peak_values = config.merge.peak_values
+        self.workers = config.merge.get('workers', 1)  # number of processes reading subjects in parallel
+        self.stacked = config.merge.get('stacked', False)  # extract peaks over all subjects at once per table
+        self.time_points = config.merge.get('time_points', 50)  # grid size of the normalised cardiac cycle
+        self.export_xlsx = config.merge.get('export_xlsx', True)  # additionally export merged data as xlsx
         self.mdata_src = config.dataset.mdata_src
         self.target_label = config.analysis.experiment.target_label
         self.experiment_name = config.analysis.experiment.name
@@ -45,27 +67,41 @@ class MergeData:
             self.metadata = [self.target_label]
 
         self.relevant = []
+        self.table_parts = {}  # table name -> (segment, dim, axis, orientation, metric)
+        self.index = {}  # subject -> {table name: file path}
         self.table_name = None
+        self.merged_path = None  # computed once by cache_path
 
     def __call__(self) -> None:
         logger.info('Merging data according to config parameters...')
-        tables_list = []
-        self.identify_tables()  # identify relevant tables w.r.t. input parameters
-        subjects = os.listdir(self.checked_src)
-        for subject in subjects:  # loop over subjects
-            self.col_names = []  # OPT: not necessary for each patient
-            self.subject_data = pd.Series(dtype='float64')
-            for table in self.loop_files(subject):
-                if self.peak_values:
-                    table = self.remove_time(table)
-                    self.extract_peak_values(table)
-                else:
-                    logger.error('peak_values=False is not implemented yet.')
-                    raise NotImplementedError
-            tables_list.append(self.subject_data)
+        merged_path = self.cache_path()
+        subjects = sorted(self.index.keys())
+        if not self.peak_values and self.stacked:
+            logger.warning('Stacked merging only supports peak values, using subject-wise merging for curves.')
+
+        # Fill preallocated feature matrix (each row represents a subject), missing tables stay NaN
+        matrix = np.full((len(subjects), len(self.col_names)), np.nan)
+        curves = None if self.peak_values else self.open_curves(subjects)
+        if self.stacked and self.peak_values:
+            self.stacked_features(subjects, matrix)
+        elif self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                rows = executor.map(self.subject_features, subjects, chunksize=max(1, len(subjects) // self.workers))
+                for row, (features, subject_curves) in enumerate(rows):  # map keeps the sorted subject order
+                    matrix[row] = features
+                    if curves is not None:
+                        curves[row] = subject_curves
+        else:
+            for row, subject in enumerate(subjects):  # loop over subjects
+                matrix[row], subject_curves = self.subject_features(subject)
+                if curves is not None:
+                    curves[row] = subject_curves
+
+        if curves is not None:
+            curves.flush()
+            del curves
 
-        # Build DataFrame from list (each row represents a subject)
-        tables = pd.DataFrame(tables_list, index=subjects, columns=self.col_names)
+        tables = pd.DataFrame(matrix, index=subjects, columns=self.col_names)
         tables = tables.rename_axis('subject').reset_index()  # add a subject column and reset index
 
         # if self.impute:  # data imputation (merged data)
@@ -78,13 +114,119 @@ class MergeData:
             tables = self.add_metadata(tables)
 
         tables = tables.sort_values(by='subject')  # save the tables for analysis
-        save_tables(out_dir=self.merged_dir, experiment_name=self.experiment_name, tables=tables)
-
-    def __del__(self) -> None:
+        tables.columns = tables.columns.astype(str)
+        os.makedirs(self.merged_dir, exist_ok=True)
+        tables.to_parquet(merged_path, index=False)
+        if self.export_xlsx:
+            save_tables(out_dir=self.merged_dir, experiment_name=self.experiment_name, tables=tables)
         logger.info('Data merging finished.')
 
+    def cache_path(self) -> str:
+        """Path of the merged data, keyed by the relevant config and a manifest of the input tables"""
+        if self.merged_path is not None:
+            return self.merged_path
+        if not self.relevant:
+            self.identify_tables()  # identify relevant tables and column schema w.r.t. input parameters
+            self.build_index()  # route files to relevant tables once for all subjects
+
+        # only settings which change the merged data, imputation is applied after reading the cache
+        merge_config = {'peak_values': self.peak_values}
+        if not self.peak_values:
+            merge_config['time_points'] = self.time_points
+        relevant_config = {
+            'dims': list(self.dims),
+            'strict': self.config.dataset.strict,
+            'merge': merge_config,
+            'experiment': OmegaConf.to_container(self.config.analysis.experiment, resolve=True),
+            'metadata': list(self.metadata),
+        }
+        sha = hashlib.sha1(json.dumps(relevant_config, sort_keys=True, default=str).encode())
+        for subject in sorted(self.index.keys()):  # manifest of input tables
+            for table_name, file_path in sorted(self.index[subject].items()):
+                stat = os.stat(file_path)
+                sha.update(f'{subject}/{table_name}/{stat.st_mtime_ns}/{stat.st_size}'.encode())
+        if os.path.isfile(self.mdata_src):
+            stat = os.stat(self.mdata_src)
+            sha.update(f'{os.path.abspath(self.mdata_src)}/{stat.st_mtime_ns}/{stat.st_size}'.encode())
+            sha.update(f'metadata_v{METADATA_CACHE_VERSION}'.encode())
+
+        self.merged_path = os.path.join(self.merged_dir, f'{self.experiment_name}_{sha.hexdigest()[:16]}.parquet')
+        return self.merged_path
+
+    def curves_path(self) -> str:
+        """Path of the curves (without extension), keyed by the same hash as the merged data"""
+        return f'{os.path.splitext(self.cache_path())[0]}_curves'
+
+    def is_cached(self) -> bool:
+        """Whether the merged data (and curves if time is kept) exist for the current config and input tables"""
+        if not os.path.isfile(self.cache_path()):
+            return False
+        return self.peak_values or all(os.path.isfile(f'{self.curves_path()}.{ext}') for ext in ['npy', 'json'])
+
+    def subject_features(self, subject: str) -> tuple:
+        """Read relevant tables of one subject and return its feature vector (and curves if time is kept)"""
+        features = np.full(len(self.col_names), np.nan)
+        curves = None if self.peak_values else np.full((len(self.col_names), self.time_points), np.nan, np.float32)
+        for table in self.loop_files(subject):
+            if curves is not None:
+                curves[self.col_slices[self.table_name]] = self.extract_curves(table)
+            table = self.remove_time(table)
+            features[self.col_slices[self.table_name]] = self.extract_peak_values(table)
+        return features, curves
+
+    def open_curves(self, subjects: list) -> np.ndarray:
+        """Create memory-mapped array (subjects x features x time points) next to the merged data"""
+        os.makedirs(self.merged_dir, exist_ok=True)
+        file_path = self.curves_path()
+        with open(f'{file_path}.json', 'w') as f:  # axis labels of the array
+            json.dump({'subjects': subjects, 'features': self.col_names, 'time_points': self.time_points}, f)
+        curves = np.lib.format.open_memmap(
+            f'{file_path}.npy',
+            mode='w+',
+            dtype=np.float32,
+            shape=(len(subjects), len(self.col_names), self.time_points),
+        )
+        curves[:] = np.nan
+        return curves
+
+    def stacked_features(self, subjects: list, matrix: np.ndarray) -> None:
+        """Stack the tables of all subjects per relevant table and extract peaks with one reduction per table"""
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        for table_name in self.relevant:
+            having = [subject for subject in subjects if table_name in self.index[subject]]
+            if not having:
+                continue
+            paths = [self.index[subject][table_name] for subject in having]
+            frames = executor.map(pd.read_excel, paths) if executor else map(pd.read_excel, paths)
+            frames = [self.remove_time(frame).rename(columns={'series, slice': 'slice'}) for frame in frames]
+            table = pd.concat(frames, keys=having, names=['subject', None])  # long frame (subject, roi, slice, samples)
+            table = table.reset_index(level=0)
+
+            # ROI analysis, remove slice-wise global rows and keep only global, endo, epi ROI
+            to_keep = SEGMENT_ROWS['roi']
+            table = table[~((table.roi == 'global') & (table.slice != 'all slices'))]
+            table = table[table.roi.str.contains('|'.join(to_keep)) == True]
+
+            samples = table.drop(columns=['subject', 'roi', 'slice'])
+            peak = samples.min(axis=1) if self.peak_is_min(table_name) else samples.max(axis=1)
+            peak = peak.groupby([table['subject'], table['roi']]).mean().unstack('roi')  # subjects x rois
+            peak = peak.reindex(index=subjects, columns=to_keep)
+            matrix[:, self.col_slices[table_name]] = peak.to_numpy(dtype=float)
+
+        if executor:
+            executor.shutdown()
+
+    def peak_is_min(self, table_name: str) -> bool:
+        """Circumferential and longitudinal strain and strain rate peak at minimum value"""
+        _, _, _, orientation, metric = self.table_parts[table_name]
+        return 'strain' in metric and orientation in ['circumf', 'longit']
+
     def identify_tables(self) -> None:
+        """Identify relevant tables and compute the column schema of the merged data once"""
         for segment in self.segments:
+            if segment not in SEGMENT_ROWS:
+                logger.error(f'Segment {segment} is not implemented yet.')
+                raise NotImplementedError
             for dim in self.dims:
                 for axis in self.axes:
                     for orientation in self.orientations:
@@ -99,41 +241,80 @@ class MergeData:
                             continue  # skip impossible or imprecise combinations
 
                         for metric in self.metrics:
-                            self.relevant.append(f'{segment}_{dim}_{axis}_{orientation}_{metric}')
+                            table_name = f'{segment}_{dim}_{axis}_{orientation}_{metric}'
+                            self.relevant.append(table_name)
+                            self.table_parts[table_name] = (segment, dim, axis, orientation, metric)
+
+        # sorted table names give the same col order as the sorted file names
+        self.relevant = sorted(self.relevant)
+        self.col_names, self.col_slices = [], {}
+        for table_name in self.relevant:
+            segment, dim, _, orientation, metric = self.table_parts[table_name]
+            prefix = f'{dim}_' if len(self.dims) > 1 else ''  # keep 2d and 3d features apart
+            start = len(self.col_names)
+            self.col_names += [f'{prefix}{row}_{orientation}_{metric}' for row in SEGMENT_ROWS[segment]]
+            self.col_slices[table_name] = slice(start, len(self.col_names))
+
+    def build_index(self) -> None:
+        """Map each subject to its relevant table files using a single compiled pattern"""
+        pattern = re.compile('(' + '|'.join(re.escape(name) for name in self.relevant) + r')_\(')
+        self.index = {}
+        for subject in os.listdir(self.checked_src):
+            tables = {}
+            subject_dir = os.path.join(self.checked_src, subject)
+            for root, _, files in os.walk(subject_dir):
+                for file in files:
+                    match = pattern.search(file) if file.endswith('.xlsx') else None
+                    if match:
+                        tables[match.group(1)] = os.path.join(root, file)
+            self.index[subject] = tables
+
+        for subject, tables in self.index.items():
+            missing = [name for name in self.relevant if name not in tables]
+            if missing:
+                logger.warning(f'Subject {subject} lacks {len(missing)} relevant tables: {missing}')
 
     def loop_files(self, subject) -> pd.DataFrame:
-        for root, _, files in os.walk(os.path.join(self.checked_src, subject)):
-            files.sort()  # sort files for consistent order of cols among subjects
-            for file in files:
-                # consider only relevant tables
-                for table_name in self.relevant:
-                    if file.endswith('.xlsx') and f'{table_name}_(' in file:
-                        # logger.info(f'Relevant table {table_name} found for subject {subject}.')
-                        self.table_name = table_name
-                        file_path = os.path.join(root, file)
-                        table = pd.read_excel(file_path)
-                        yield table
+        for table_name, file_path in self.index[subject].items():
+            self.table_name = table_name
+            table = pd.read_excel(file_path)
+            yield table
+
+    def extract_curves(self, table) -> np.ndarray:
+        """Average ROI curves and resample them onto the normalised cardiac cycle, ordered as the col schema"""
+        table = table.rename(columns={'series, slice': 'slice'})
+        to_keep = SEGMENT_ROWS['roi']
+        table = table.drop(table[(table.roi == 'global') & (table.slice != 'all slices')].index)
+        table = table[table.roi.str.contains('|'.join(to_keep)) == True]
+
+        sample_cols = [col for col in table.columns if 'sample' in str(col)]
+        time_cols = [col for col in table.columns if 'time' in str(col)]
+        times = pd.to_numeric(table[time_cols].iloc[0], errors='coerce').to_numpy() if len(table.index) else []
+        if len(times) != len(sample_cols) or np.isnan(times).any() or np.any(np.diff(times) <= 0):
+            times = np.arange(len(sample_cols), dtype=float)  # fall back to sample index
+
+        values = table.groupby(by='roi', sort=False)[sample_cols].mean().reindex(to_keep).to_numpy(dtype=float)
+        return resample_curves(times, values, self.time_points)
 
     def remove_time(self, table) -> pd.DataFrame:
         """Remove time columns from ROI analysis tables"""
         return table[table.columns.drop(list(table.filter(regex='time')))]
 
-    def extract_peak_values(self, table) -> None:
-        """Extract peak values from ROI analysis tables"""
+    def extract_peak_values(self, table) -> np.ndarray:
+        """Extract peak values from ROI analysis tables, ordered as the col schema of the table"""
         info_cols = 1 if 'aha' in self.table_name else 2  # AHA data got one info col, ROI data got two info cols
         if 'long_axis' in self.table_name:  # ensure consistent naming between short and long axis
             table = table.rename(columns={'series, slice': 'slice'})
 
         if 'roi' in self.table_name:  # ROI analysis, remove slice-wise global rows and  keep only global, endo, epi ROI
             table = table.drop(table[(table.roi == 'global') & (table.slice != 'all slices')].index)
-            to_keep = ['global', 'endo', 'epi']
+            to_keep = SEGMENT_ROWS['roi']
             table = table[table.roi.str.contains('|'.join(to_keep)) == True]
 
         # if self.impute:  # data imputation (table-wise)
         #     table.iloc[:, info_cols:] = self.impute_data(table.iloc[:, info_cols:])
 
-        # Circumferential and longitudinal strain and strain rate peak at minimum value
-        if 'strain' in self.table_name and ('circumf' in self.table_name or 'longit' in self.table_name):
+        if self.peak_is_min(self.table_name):
             peak = table.iloc[:, info_cols:].min(axis=1, skipna=True)  # compute peak values over sample cols
         else:
             peak = table.iloc[:, info_cols:].max(axis=1, skipna=True)
@@ -142,15 +323,9 @@ class MergeData:
 
         if 'roi' in self.table_name:  # ROI analysis -> group by global/endo/epi
             table = table.groupby(by='roi', sort=False).agg('mean', numeric_only=True)  # remove slice-wise global rows
+            table = table.reindex(to_keep)  # same row order for all subjects
 
-        col_names = []  # store column names for later
-        for segment in to_keep:
-            orientation = [o for o in self.orientations if o in self.table_name][0]
-            metric = [m for m in self.metrics if m in self.table_name][0]
-            col_names.append(f'{segment}_{orientation}_{metric}')
-            self.col_names.append(f'{segment}_{orientation}_{metric}')
-
-        self.subject_data = pd.concat((self.subject_data, pd.Series(list(table.iloc[:, 0]), index=col_names)), axis=0)
+        return table.iloc[:, 0].to_numpy(dtype=float)
 
     # def impute_data(self, table: pd.DataFrame):
     #     """Impute missing values in table"""
@@ -169,16 +344,41 @@ class MergeData:
     #
     #     return table
 
+    def read_metadata(self) -> pd.DataFrame:
+        """Read relevant metadata columns, the workbook is converted once to parquet keyed by path, mtime and size"""
+        stat = os.stat(self.mdata_src)
+        key = f'{os.path.abspath(self.mdata_src)}_{stat.st_mtime_ns}_{stat.st_size}_{METADATA_CACHE_VERSION}'
+        key = hashlib.sha1(key.encode()).hexdigest()
+        name = os.path.splitext(os.path.basename(self.mdata_src))[0]
+        cache_path = os.path.join(self.merged_dir, 'metadata_cache', f'{name}_{key[:16]}.parquet')
+
+        if not os.path.isfile(cache_path):
+            logger.info(f'Converting metadata to {cache_path}')
+            mdata = pd.read_excel(self.mdata_src)
+            mdata.columns = mdata.columns.astype(str)
+            for col in mdata.select_dtypes(include='object').columns:  # parquet needs one type per column
+                numeric = pd.to_numeric(mdata[col], errors='coerce')
+                text = numeric.isna() & mdata[col].notna()
+                if text.sum() < numeric.notna().sum():  # mostly numeric, keep comparable with numbers
+                    if text.any():
+                        logger.warning(f'Metadata column {col}: {text.sum()} non-numeric cells set to NaN')
+                    mdata[col] = numeric
+                else:
+                    mdata[col] = mdata[col].where(mdata[col].isna(), mdata[col].astype(str))
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            mdata.to_parquet(cache_path, index=False)
+
+        return pd.read_parquet(cache_path, columns=list(self.metadata))
+
     def add_metadata(self, tables):
         """Add metadata to tables"""
         try:
-            mdata = pd.read_excel(self.mdata_src)
+            mdata = self.read_metadata()
         except FileNotFoundError:
             logger.error(f'Metadata file not found, check path: {self.mdata_src}' '\nContinue without metadata...')
             mdata = None
 
         if mdata is not None:
-            mdata = mdata[self.metadata]
             # clean some errors in metadata
             if 'mace' in self.metadata:  # TODO: add for other mace types as well (e.g. in function)
                 mdata.loc[mdata['mace'] == 999, 'mace'] = 0
@@ -194,13 +394,15 @@ class MergeData:
             # clean subject IDs
             mdata = mdata[mdata['redcap_id'].notna()]  # remove rows without redcap_id
             mdata['redcap_id'] = mdata['redcap_id'].astype(int).astype(str) + '_rc'
-            mdata['pat_id'] = mdata['pat_id'].astype(object).apply(lambda x: str(int(x)) + '_p' if pd.notnull(x) else x)
-            mdata['pat_id'].fillna(mdata['redcap_id'], inplace=True)  # patients without pat_id get redcap_id
-            mdata = mdata.rename(columns={'pat_id': 'subject'})
-
-            # merge the cvi42 data with available metadata
-            tables = tables.merge(mdata, how='inner', on='subject')
-            tables = tables.drop('subject', axis=1)  # use redcap_id as subject id
+            pat_id = pd.to_numeric(mdata['pat_id'], errors='coerce')
+            pat_id = pat_id.where(pat_id % 1 == 0)  # text and non-integer IDs are invalid
+            # patients without valid pat_id get redcap_id
+            mdata['pat_id'] = (pat_id.astype('Int64').astype(str) + '_p').where(pat_id.notna(), mdata['redcap_id'])
+            mdata = mdata.rename(columns={'pat_id': 'subject'}).set_index('subject')
+
+            # merge the cvi42 data with available metadata (indexed join on subject)
+            tables = tables.set_index('subject').join(mdata, how='inner')
+            tables = tables.reset_index(drop=True)  # use redcap_id as subject id
             tables = tables.rename(columns={'redcap_id': 'subject'})
 
             # remove any metadata columns containing less than threshold data
@@ -1,30 +1,49 @@
 from functools import wraps
 
+import numpy as np
 import pandas as pd
 from loguru import logger
 from sklearn import preprocessing
 
+from excel.analysis.utils.helpers import feature_values, to_frame
+
 
 def data_bubble(func):
     @wraps(func)
     def wrapper(self, *args):
         data = args[0]
-        if data.isna().any(axis=None):
+        features, values = feature_values(data, self.target_label)  # keep label col as is
+        if np.isnan(values).any():
             raise ValueError('Data contains NaN values, consider imputing data')
-        tmp_label = data[self.target_label]  # keep label col as is
-        arr_data = data.values  # returns a numpy array
-        norm_data = func(self, arr_data)
-        norm_data = pd.DataFrame(norm_data, index=data.index, columns=data.columns)
-        norm_data[self.target_label] = tmp_label
+        norm_data = to_frame(func(self, values), data.index, features)
+        if self.target_label in data.columns:
+            norm_data.insert(data.columns.get_loc(self.target_label), self.target_label, data[self.target_label])
         return norm_data
 
     return wrapper
 
 
+SCALERS = {  # normalisers which can be fitted on training data and applied to other data
+    'z_score_norm': preprocessing.StandardScaler,
+    'min_max_norm': preprocessing.MinMaxScaler,
+    'max_abs_norm': preprocessing.MaxAbsScaler,
+    'robust_norm': preprocessing.RobustScaler,
+    'quantile_norm': preprocessing.QuantileTransformer,
+    'power_norm': preprocessing.PowerTransformer,
+}
+
+
+def new_scaler(method: str):
+    """Unfitted scaler of a normalisation method, returning frames where sklearn supports set_output"""
+    scaler = SCALERS[method]()
+    return scaler.set_output(transform='pandas') if hasattr(scaler, 'set_output') else scaler
+
+
 class Normaliser:
     def __init__(self, target_label=None) -> None:
         self.target_label = target_label
         self.auto_norm_method = None
+        self.fitted_norms = {}  # fitted scalers by method, feature set and training subjects
 
     @data_bubble
     def l1_norm(self, data: pd.DataFrame) -> pd.DataFrame:
@@ -39,84 +58,79 @@ class Normaliser:
     @data_bubble
     def z_score_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Z score data"""
-        return preprocessing.StandardScaler().fit_transform(data)
+        return new_scaler('z_score_norm').fit_transform(data)
 
     @data_bubble
     def min_max_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Min max scale data"""
-        return preprocessing.MinMaxScaler().fit_transform(data)  # default is 0-1
+        return new_scaler('min_max_norm').fit_transform(data)  # default is 0-1
 
     @data_bubble
     def max_abs_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Max abs scale data"""
-        return preprocessing.MaxAbsScaler().fit_transform(data)  # default is 0-1
+        return new_scaler('max_abs_norm').fit_transform(data)  # default is 0-1
 
     @data_bubble
     def robust_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Robust scale data"""
-        return preprocessing.RobustScaler().fit_transform(data)
+        return new_scaler('robust_norm').fit_transform(data)
 
     @data_bubble
     def quantile_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Quantile transform data"""
-        return preprocessing.QuantileTransformer().fit_transform(data)
+        return new_scaler('quantile_norm').fit_transform(data)
 
     @data_bubble
     def power_norm(self, data: pd.DataFrame) -> pd.DataFrame:
         """Power transform data"""
-        return preprocessing.PowerTransformer().fit_transform(data)
+        return new_scaler('power_norm').fit_transform(data)
+
+    def fit_norm(self, data: pd.DataFrame, method: str = 'z_score_norm'):
+        """Fit normaliser on training data once, refits with the same method, features and subjects are cached"""
+        if method not in SCALERS:
+            raise ValueError(f'Normaliser {method} cannot be fitted, must be one of {list(SCALERS)}')
+        features = [col for col in data.columns if col != self.target_label]
+        key = (method, tuple(features), tuple(data.index))
+        if key not in self.fitted_norms:
+            self.fitted_norms[key] = SCALERS[method]().fit(data[features])
+        return self.fitted_norms[key]
+
+    def apply_norm(self, data: pd.DataFrame, scaler) -> pd.DataFrame:
+        """Normalise data (e.g. test or validation folds) with a scaler from fit_norm, without refitting"""
+        features = list(scaler.feature_names_in_)
+        norm_data = data.copy()
+        norm_data[features] = scaler.transform(data[features])
+        return norm_data
 
     def auto_norm(self, data: pd.DataFrame) -> pd.DataFrame:
-        """Auto normalise data based on data type per column"""
+        """Auto normalise data based on data type per column, each normaliser is applied once to all its columns"""
         if data.isna().any(axis=None):
             raise ValueError('Data contains NaN values, consider imputing data')
-        tmp_label = data[self.target_label]  # keep label col as i
-        for col_name in data.columns:  # iterate over columns
-            col_type = str(data[col_name].dtype)
-            col_unique_vals = data[col_name].unique()
-            data = self.__binary_norm(data, col_name, col_type, col_unique_vals)
-            data = self.__continuous_norm(data, col_name, col_type, col_unique_vals)
-            data = self.__object_norm(data, col_name, col_type)
-            data = self.__datatime_norm(data, col_name, col_type)
-        data[self.target_label] = tmp_label
-        return data
-
-    def __normalise_accordingly(self, data, col_name, data_type_name) -> pd.DataFrame:
-        logger.trace(f'{data_type_name.capitalize()} data detected in {col_name}')
-        col_data = data[col_name]
-        col_values = col_data.values.reshape(-1, 1)
-        norm = getattr(self, self.auto_norm_method[data_type_name])
-        ori_norm = norm.__wrapped__  # get original unwrapped function
-        norm_col_values = ori_norm(self, col_values)
-        col_data = pd.Series(norm_col_values.reshape(-1), index=col_data.index)
-        data[col_name] = col_data
-        return data
-
-    def __binary_norm(self, data, col_name, col_type, col_unique_vals) -> pd.DataFrame:
-        """Normalise binary data if present"""
-        if ('int' in col_type or 'float' in col_type) and col_unique_vals.size == 2:
-            data = self.__normalise_accordingly(data, col_name, data_type_name='binary')
-        return data
-
-    def __continuous_norm(self, data, col_name, col_type, col_unique_vals) -> pd.DataFrame:
-        """Normalise continuous data if present"""
-        if ('int' in col_type or 'float' in col_type) and col_unique_vals.size > 2:
-            data = self.__normalise_accordingly(data, col_name, data_type_name='continuous')
-        return data
-
-    def __object_norm(self, data, col_name, col_type) -> pd.DataFrame:
-        """Normalise object data if present"""
-        if 'object' in col_type:
-            # data = self.__normalise_accordingly(data, col_name, data_type_name='object')
-            logger.warning('Object normalisation is not implemented yet')
+        data_types = self.__data_types(data).drop(self.target_label, errors='ignore')  # keep label col as is
+        for data_type_name in ['object', 'datatime']:
+            if (data_types == data_type_name).any():
+                logger.warning(f'{data_type_name.capitalize()} normalisation is not implemented yet')
+        data_types = data_types[data_types.isin(['binary', 'continuous'])]
+
+        data = data.copy()
+        methods = data_types.map(lambda data_type_name: self.auto_norm_method[data_type_name])
+        for method, col_names in methods.groupby(methods).groups.items():
+            logger.trace(f'Normalising {len(col_names)} columns with {method}')
+            norm = getattr(self, method).__wrapped__  # get original unwrapped function
+            data[list(col_names)] = np.asarray(norm(self, data[col_names].to_numpy(dtype=float)))
         return data
 
-    def __datatime_norm(self, data, col_name, col_type) -> pd.DataFrame:
-        """Normalise datetime data if present"""
-        if 'datetime' in col_type:
-            # data = self.__normalise_accordingly(data, col_name, data_type_name='datetime')
-            logger.warning('Datetime normalisation is not implemented yet')
-        return data
+    @staticmethod
+    def __data_types(data: pd.DataFrame) -> pd.Series:
+        """Data type name of each column, numeric columns are binary if they have two unique values"""
+        kinds = data.dtypes.map(lambda dtype: dtype.kind)
+        n_unique = data.nunique()
+        data_types = pd.Series('constant', index=data.columns)
+        data_types[kinds.isin(['i', 'u', 'f']) & (n_unique == 2)] = 'binary'
+        data_types[kinds.isin(['i', 'u', 'f']) & (n_unique > 2)] = 'continuous'
+        data_types[kinds == 'O'] = 'object'
+        data_types[kinds == 'M'] = 'datatime'
+        return data_types
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+"""Plotting module, analysis steps enqueue plots which are rendered off the critical path
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+matplotlib.use('Agg')  # render without display, also in worker processes
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import plotly.express as px
+import seaborn as sns
+from loguru import logger
+
+PLOT_LEVELS = ['none', 'essential', 'all']
+
+
+class Plotter:
+    """Render plots synchronously (workers=0) or in a background process pool
+
+    level 'none' skips all plots, 'essential' only renders plots needed to interpret the results
+    (feature importances, RFE curves, confusion matrices), 'all' renders everything.
+    """
+
+    def __init__(self, level: str = 'all', workers: int = 0) -> None:
+        if level not in PLOT_LEVELS:
+            raise ValueError(f'Invalid plot level {level}, must be one of {PLOT_LEVELS}')
+        self.level = level
+        self.workers = workers
+        self.executor = None
+        self.futures = []
+
+    def __getstate__(self) -> dict:
+        """Pools cannot be pickled, plotters sent to worker processes render in place"""
+        return {'level': self.level, 'workers': 0, 'executor': None, 'futures': []}
+
+    def submit(self, func, *args, essential: bool = False) -> None:
+        """Render plot func(*args) now or in the background, depending on level and workers"""
+        if self.level == 'none' or (self.level == 'essential' and not essential):
+            return
+        if self.workers < 1:
+            func(*args)
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.futures.append(self.executor.submit(func, *args))
+
+    def wait(self) -> None:
+        """Wait for all enqueued plots, failed plots are logged but do not abort the analysis"""
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as error:
+                logger.error(f'Plot failed: {error}')
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def univariate_plots(job_dir: str, to_analyse: pd.DataFrame, target_label: str) -> None:
+    """Box plots w.r.t. target and overall, and distribution of each feature"""
+    data_long = to_analyse.melt(id_vars=[target_label])
+    fig = plt.figure()
+    sns.boxplot(
+        data=data_long,
+        x='value',
+        y='variable',
+        hue=target_label,
+        orient='h',
+        meanline=True,
+        showmeans=True,
+    )
+    plt.axvline(x=0, alpha=0.7, color='grey', linestyle='--')
+    plt.tight_layout()
+    plt.savefig(os.path.join(job_dir, f'box_plot_{target_label}.pdf'))
+    plt.close(fig)
+
+    to_analyse = to_analyse.drop(target_label, axis=1)  # now remove hue column
+
+    fig = plt.figure()
+    sns.boxplot(data=to_analyse, orient='h', meanline=True, showmeans=True, whis=1.5)
+    plt.axvline(x=0, alpha=0.7, color='grey', linestyle='--')
+    plt.tight_layout()
+    plt.savefig(os.path.join(job_dir, 'box_plot.pdf'))
+    plt.close(fig)
+
+    grid = sns.displot(data=to_analyse, kind='kde')
+    plt.tight_layout()
+    plt.savefig(os.path.join(job_dir, 'dis_plot.pdf'))
+    plt.close(grid.figure)
+
+
+def correlation_heatmap(job_dir: str, matrix: pd.DataFrame) -> None:
+    fig = plt.figure(figsize=(20, 20))
+    sns.heatmap(matrix, annot=True, xticklabels=True, yticklabels=True, cmap='viridis')
+    plt.xticks(rotation=90)
+    plt.savefig(os.path.join(job_dir, 'corr_plot.pdf'))
+    plt.close(fig)
+
+
+def rfecv_curve(job_dir: str, rfe_estimator: str, cv_results: dict, scoring: str) -> None:
+    """Performance for increasing number of features"""
+    fig = plt.figure()
+    plt.xlabel('Number of features selected')
+    plt.ylabel(f'Mean {scoring}')
+    plt.grid(alpha=0.5)
+    plt.errorbar(
+        cv_results['n_features'],
+        cv_results['mean_test_score'],
+        yerr=cv_results['std_test_score'],
+    )
+    plt.title(f'Recursive Feature Elimination for {rfe_estimator} estimator')
+    plt.savefig(os.path.join(job_dir, f'RFECV_{rfe_estimator}.pdf'))
+    plt.close(fig)
+
+
+def importance_bars(job_dir: str, rfe_estimator: str, importances: pd.DataFrame, target_label: str) -> None:
+    ax = importances.plot.barh()
+    fig = ax.get_figure()
+    plt.title(f'Feature importance (top {len(importances)})\n{rfe_estimator} estimator for target: {target_label}')
+    plt.tight_layout()
+    plt.gca().legend_.remove()
+    plt.savefig(os.path.join(job_dir, f'feature_importance_{rfe_estimator}.pdf'), dpi=fig.dpi)
+    plt.close(fig)
+
+
+def stacked_importances(job_dir: str, feature_scores: pd.DataFrame, estimators: list, target_label: str, max_score):
+    """Summed importance ranks of all estimators"""
+    ax = feature_scores.plot(
+        x='feature',
+        y=estimators,
+        kind='barh',
+        stacked=True,
+        colormap='viridis',
+    )
+    fig = ax.get_figure()
+    fig.legend(loc='lower right', borderaxespad=4.5)
+    plt.title(f'Feature importance\nAll estimators for target: {target_label}')
+    plt.xlabel(f'Summed importance (max {max_score})')
+    plt.tight_layout()
+    plt.gca().legend_.remove()
+    plt.savefig(os.path.join(job_dir, 'feature_importance_all.pdf'), dpi=fig.dpi)
+    plt.close(fig)
+
+
+def bubble_plots(job_dir: str, name: str, proj_2d, proj_3d, y_train: pd.Series, target_label: str) -> None:
+    """2D and 3D scatter plots of a dimensionality reduction"""
+    fig_2d = px.scatter(
+        proj_2d,
+        x=0,
+        y=1,
+        color=y_train,
+        labels={'color': target_label},
+        title=f'{name} 2D',
+    )
+    fig_3d = px.scatter_3d(
+        proj_3d,
+        x=0,
+        y=1,
+        z=2,
+        color=y_train,
+        labels={'color': target_label},
+        title=f'{name} 3D',
+    )
+    fig_3d.update_traces(marker_size=5)
+
+    fig_2d.write_image(os.path.join(job_dir, f'{name}_2d.svg'))
+    fig_2d.write_html(os.path.join(job_dir, f'{name}_2d.html'))
+    fig_3d.write_html(os.path.join(job_dir, f'{name}_3d.html'))
+
+
+def confusion_matrix_plot(out_dir: str, name: str, cm) -> None:
+    fig = plt.figure(figsize=(10, 7))
+    plt.title('Confusion matrix')
+    sns.heatmap(cm, annot=True, fmt='d')
+    plt.xlabel('Predicted')
+    plt.ylabel('Truth')
+    plt.savefig(os.path.join(out_dir, f'confusion_matrix_{name}.pdf'))
+    plt.close(fig)
+
+
+def regression_plot(out_dir: str, name: str, y_true: pd.Series, y_pred, target_label: str) -> None:
+    fig = plt.figure(figsize=(10, 7))
+    plt.title(f'Regression on {target_label}')
+    sns.regplot(x=y_true, y=y_pred, ci=None)
+    plt.xlabel(f'True {target_label}')
+    plt.ylabel(f'Predicted {target_label}')
+    plt.savefig(os.path.join(out_dir, f'regression_{name}.pdf'))
+    plt.close(fig)
@@ -1,6 +1,6 @@
-import matplotlib.pyplot as plt
+import os
+
 import pandas as pd
-import seaborn as sns
 from imblearn.over_sampling import RandomOverSampler
 from loguru import logger
 from sklearn.ensemble import VotingClassifier, VotingRegressor
@@ -16,21 +16,26 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 
 from excel.analysis.utils.cross_validation import CrossValidation
-from excel.analysis.utils.helpers import init_estimator
+from excel.analysis.utils.helpers import cpu_budget, init_estimator
+from excel.analysis.utils import plots
 from excel.analysis.utils.normalisers import Normaliser
 
 
 class VerifyFeatures(Normaliser):
     """Train random forest classifier to verify feature importance"""
 
-    def __init__(self, config, v_data, v_data_test=None, features=None, task: str = 'classification'):
+    def __init__(self, config, v_data, v_data_test=None, features=None, task: str = 'classification', plotter=None):
         super().__init__()
+        self.out_dir = os.path.join(config.dataset.out_dir, '7_verification', config.analysis.experiment.name)
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.plotter = plotter or plots.Plotter(config.analysis.run.get('plots', 'all'))
         self.target_label = config.analysis.experiment.target_label
         self.seed = config.analysis.run.seed
         self.scoring = config.analysis.run.scoring
         self.class_weight = config.analysis.run.class_weight
         self.oversample = config.analysis.run.verification.oversample
         self.param_grids = config.analysis.run.verification.param_grids
+        self.n_jobs = cpu_budget(config.analysis.run.get('n_jobs', -1))
         self.task = task
         models_dict = config.analysis.run.verification.models
         self.models = [model for model in models_dict if models_dict[model]]
@@ -52,6 +57,10 @@ class VerifyFeatures(Normaliser):
             self.x_train, self.y_train = self.prepare_data(v_data, features_to_keep=features)
             self.x_test, self.y_test = self.prepare_data(v_data_test, features_to_keep=features)
 
+        scaler = self.fit_norm(self.x_train)  # fit on training data only, test data is scaled likewise
+        self.x_train = self.apply_norm(self.x_train, scaler)
+        self.x_test = self.apply_norm(self.x_test, scaler)
+
         if self.oversample:
             oversampler = RandomOverSampler(random_state=self.seed)
             self.x_train, self.y_train = oversampler.fit_resample(self.x_train, self.y_train)
@@ -63,17 +72,17 @@ class VerifyFeatures(Normaliser):
             logger.info(f'Optimising {model} model...')
             param_grid = self.param_grids[model]
             estimator, cross_validator, scoring = init_estimator(
-                model, self.task, self.seed, self.scoring, self.class_weight
-            )
+                model, self.task, self.seed, self.scoring, self.class_weight, n_jobs=1
+            )  # GridSearchCV parallelises over candidates and folds, avoid nested parallelism
 
             optimiser = CrossValidation(
-                self.x_train, self.y_train, estimator, cross_validator, param_grid, scoring, self.seed
+                self.x_train, self.y_train, estimator, cross_validator, param_grid, scoring, self.seed, self.n_jobs
             )
             best_estimator = optimiser()
             best_estimators.append((model, best_estimator))
             y_pred = best_estimator.predict(self.x_test)
             logger.info(f'Model was optimised using {self.scoring[self.task]}.')
-            self.performance_statistics(y_pred)
+            self.performance_statistics(y_pred, model)
 
         for ensemble in self.ensemble:
             logger.info(f'Combining optimised models in {ensemble} estimator')
@@ -95,11 +104,10 @@ class VerifyFeatures(Normaliser):
                 raise NotImplementedError
 
             y_pred = ens_estimator.predict(self.x_test)
-            self.performance_statistics(y_pred)
+            self.performance_statistics(y_pred, ensemble)
 
     def prepare_data(self, data: pd.DataFrame, features_to_keep: list = None):
         y = data[self.target_label]
-        data = self.z_score_norm(data)
         x = data.drop(
             columns=[c for c in data.columns if c not in features_to_keep], axis=1
         )  # Keep only selected features
@@ -108,7 +116,7 @@ class VerifyFeatures(Normaliser):
 
         return x, y
 
-    def performance_statistics(self, y_pred):
+    def performance_statistics(self, y_pred, name: str):
         if self.task == 'classification':
             print('Accuracy', accuracy_score(self.y_test, y_pred, normalize=True))
             print('Average precision', average_precision_score(self.y_test, y_pred))
@@ -116,18 +124,10 @@ class VerifyFeatures(Normaliser):
 
             cm = confusion_matrix(self.y_test, y_pred)
             print(cm)
-            plt.figure(figsize=(10, 7))
-            plt.title('Confusion matrix')
-            sns.heatmap(cm, annot=True, fmt='d')
-            plt.xlabel('Predicted')
-            plt.ylabel('Truth')
-            # plt.show()
+            self.plotter.submit(plots.confusion_matrix_plot, self.out_dir, name, cm, essential=True)
         else:  # regression
             print('Mean absolute error', mean_absolute_error(self.y_test, y_pred))
             print('R2 score', r2_score(self.y_test, y_pred))
-            plt.figure(figsize=(10, 7))
-            plt.title(f'Regression on {self.target_label}')
-            sns.regplot(x=self.y_test, y=y_pred, ci=None)
-            plt.xlabel(f'True {self.target_label}')
-            plt.ylabel(f'Predicted {self.target_label}')
-            plt.show()
+            self.plotter.submit(
+                plots.regression_plot, self.out_dir, name, self.y_test, y_pred, self.target_label, essential=True
+            )
@@ -1,5 +1,7 @@
 import os
 
+import pandas as pd
+
 
 def checked_dir(dims, strict):
     """Set dir name according to requested dims"""
@@ -15,3 +17,14 @@ def checked_dir(dims, strict):
         raise NotImplementedError
 
     return dir_name
+
+
+def read_table(file_path: str, columns=None) -> pd.DataFrame:
+    """Read .xlsx or .parquet table, optionally only the given columns (list or callable on column names)"""
+    if file_path.endswith('.parquet'):
+        if callable(columns):
+            import pyarrow.parquet as pq
+
+            columns = [col for col in pq.read_schema(file_path).names if columns(col)]
+        return pd.read_parquet(file_path, columns=columns)
+    return pd.read_excel(file_path, usecols=columns)
@@ -1,10 +1,10 @@
 import os
 
 import hydra
+from loguru import logger
 from omegaconf import DictConfig
 import pandas as pd
 import numpy as np
-from functools import reduce
 
 pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
@@ -22,42 +22,78 @@ def cleanup(config: DictConfig) -> None:
     # Parse config parameters
     src_dir = config.src_dir
     files = config.files
-    writer = pd.ExcelWriter(os.path.join(src_dir, 'combined.xlsx'), engine='xlsxwriter')
-    dataframes = []
-    merge_on = ['record_id']
-    colors = ['lightgrey', 'lightcoral', 'lightyellow', 'lightseagreen', 'lightcyan', 'lightblue']
+    write_xlsx = config.get('write_xlsx', True)  # styled xlsx with one sheet per source, slow for many sources
+    fast_format = config.get('fast_format', None)  # additional parquet or csv export of the combined table
+    dataframes = {}
+    merge_on = 'record_id'
+    # light grey, coral, yellow, seagreen, cyan, blue
+    colors = ['#D3D3D3', '#F08080', '#FFFFE0', '#20B2AA', '#E0FFFF', '#ADD8E6']
 
     for key, file in files.items():
         # Read data (only need first sheet)
         data = pd.read_excel(os.path.join(src_dir, file))
         # Clean data
         data = data.drop(index=0, axis=0)  # drop first row
-        data.iloc[:, 11:] = data.iloc[:, 11:].replace(r'[a-zA-Z%/²-]', '', regex=True)  # remove units
-        data.iloc[:, 11:] = data.iloc[:, 11:].apply(lambda x: x.str.strip() if x.dtype == "object" else x)
-        data.iloc[:, 11:] = data.iloc[:, 11:].replace([0, ''], np.nan, regex=True)  # set 0 values to NaN
-        data.iloc[:, 11:] = data.iloc[:, 11:].astype(float)
-        data = data.sort_values(by='record_id')
+        data = pd.concat((data.iloc[:, :11], strip_units(data.iloc[:, 11:])), axis=1)
         data = data.dropna(how='all', axis=1)  # drop empty columns
+        data = data.set_index(merge_on).sort_index()
+        if data.index.duplicated().any():
+            logger.warning(f'Duplicated {merge_on} in {key}, keeping first occurrence')
+            data = data[~data.index.duplicated(keep='first')]
 
-        data.columns = ['{}{}'.format(c, '' if c in merge_on else f'_{key}') for c in data.columns]
-        dataframes.append(data)
-        # Write data to new excel file
-        data.to_excel(writer, sheet_name=key, index=False)
-
-    # Combine all sheets into one
-    combined = reduce(lambda left, right: pd.merge(left, right, on=merge_on, how='outer'), dataframes)
-    combined.style.apply(lambda col: highlight_cols(col, files.keys(), colors), axis=0).to_excel(
-        writer, sheet_name='combined', index=False
-    )
-    writer.close()
-
-
-def highlight_cols(col: pd.Series, suffixes: list, colors: list) -> str:
-    """Highlight columns based on suffixes"""
-    for i, suffix in enumerate(suffixes):
-        if suffix in col.name:
-            return [f'background-color: {colors[i]}'] * (len(col) - 1)
-    return [''] * (len(col) - 1)
+        data.columns = [f'{c}_{key}' for c in data.columns]
+        dataframes[key] = data
+
+    # Combine all sheets into one (single indexed join instead of pairwise merges)
+    combined = pd.concat(dataframes.values(), axis=1, join='outer').sort_index().reset_index()
+
+    if fast_format is not None:
+        export_fast(combined, os.path.join(src_dir, 'combined'), fast_format)
+
+    if write_xlsx:
+        with pd.ExcelWriter(os.path.join(src_dir, 'combined.xlsx'), engine='xlsxwriter') as writer:
+            for key, data in dataframes.items():
+                data.reset_index().to_excel(writer, sheet_name=key, index=False)
+            combined.to_excel(writer, sheet_name='combined', index=False)
+            highlight_cols(writer, combined, list(files.keys()), colors)
+
+
+def strip_units(data: pd.DataFrame) -> pd.DataFrame:
+    """Remove units and set 0 or empty values to NaN, vectorised over the whole block"""
+    raw = pd.Series(data.to_numpy(dtype=object).ravel())
+    values = pd.to_numeric(raw, errors='coerce')  # cells which are numeric already, kept including their sign
+    text = raw[values.isna() & raw.notna()].astype(str)
+    text = text.str.replace(r'[a-zA-Z%/²-]', '', regex=True).str.strip()  # remove units
+    values = values.fillna(pd.to_numeric(text, errors='coerce'))
+    values = values.replace(0, np.nan)  # set 0 and empty values to NaN
+    return pd.DataFrame(values.to_numpy().reshape(data.shape), index=data.index, columns=data.columns)
+
+
+def export_fast(data: pd.DataFrame, file_path: str, file_format: str) -> None:
+    """Export table as parquet or csv"""
+    if file_format == 'parquet':
+        data = data.copy()
+        data.columns = data.columns.astype(str)
+        object_cols = data.select_dtypes(include='object').columns
+        # parquet requires consistent column types, missing values stay missing
+        data[object_cols] = data[object_cols].where(data[object_cols].isna(), data[object_cols].astype(str))
+        data.to_parquet(f'{file_path}.parquet', index=False)
+    elif file_format == 'csv':
+        data.to_csv(f'{file_path}.csv', index=False)
+    else:
+        raise ValueError(f'Unknown export format {file_format}, must be either parquet or csv')
+
+
+def highlight_cols(writer: pd.ExcelWriter, data: pd.DataFrame, suffixes: list, colors: list) -> None:
+    """Highlight columns based on suffixes (column formats instead of per-cell styles)"""
+    workbook = writer.book
+    worksheet = writer.sheets['combined']
+    formats = [workbook.add_format({'bg_color': color}) for color in colors]
+    for i, col in enumerate(data.columns):
+        for j, suffix in enumerate(suffixes):
+            if str(col).endswith(f'_{suffix}'):
+                worksheet.set_column(i, i, None, formats[j % len(formats)])
+                break
 
 
 if __name__ == '__main__':
@@ -0,0 +1,190 @@
+""" Stage runner for the excel pipeline, a stage is only rerun if its inputs, its config or any upstream stage changed
+"""
+
+import hashlib
+import json
+import os
+import sys
+import uuid
+from copy import deepcopy
+
+import hydra
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+
+from excel.global_helpers import checked_dir
+
+
+def run_preprocessing(config: DictConfig) -> None:
+    from excel.pre_processing.pre_processing import Preprocessing
+
+    Preprocessing(config)()
+
+
+def run_condense(config: DictConfig) -> None:
+    from excel.aha_segment.refinement.table_condenser import TableCondenser
+
+    TableCondenser(stage_dir(config, 'preprocessing'), stage_dir(config, 'condense'), workers=config.pipeline.workers)()
+
+
+def run_accelerations(config: DictConfig) -> None:
+    from excel.aha_segment.refinement.calculate_accelerations import CalculateAcceleration
+
+    CalculateAcceleration(stage_dir(config, 'preprocessing'), stage_dir(config, 'accelerations'))()
+
+
+def run_merge_segments(config: DictConfig) -> None:
+    from excel.aha_segment.refinement.table_merger import METRIC_NAMES, MergeSegments
+
+    merger = MergeSegments(stage_dir(config, 'condense'), stage_dir(config, 'merge_segments'), config.pipeline.workers)
+    for dim in config.dataset.dims:
+        merger(dim, METRIC_NAMES)
+
+
+def run_analysis(config: DictConfig) -> None:
+    from excel.analysis.analysis import Analysis
+
+    Analysis(config)()
+
+
+# name -> (function, upstream stages, relevant config keys, config keys pointing to input files/dirs)
+STAGES = {
+    'preprocessing': (
+        run_preprocessing,
+        [],
+        ['dataset.dims', 'dataset.strict', 'dataset.save_intermediate', 'dataset.save_final'],
+        ['dataset.raw_dir'],
+    ),
+    'condense': (run_condense, ['preprocessing'], [], []),
+    'accelerations': (run_accelerations, ['preprocessing'], [], []),
+    'merge_segments': (run_merge_segments, ['condense', 'accelerations'], ['dataset.dims'], []),
+    'analysis': (
+        run_analysis,
+        ['preprocessing'],
+        ['dataset.dims', 'dataset.strict', 'merge', 'analysis'],
+        ['dataset.mdata_src'],
+    ),
+}
+
+
+def stage_dir(config: DictConfig, stage: str) -> str:
+    """Output dir of a stage"""
+    out_dir = config.dataset.out_dir
+    if stage == 'preprocessing':
+        return os.path.join(out_dir, '4_checked', checked_dir(config.dataset.dims, config.dataset.strict))
+    if stage in ['condense', 'accelerations']:  # accelerations are stored next to the condensed tables
+        return os.path.join(out_dir, 'aha_condensed')
+    if stage == 'merge_segments':
+        return os.path.join(out_dir, 'aha_merged')
+    return os.path.join(out_dir, '5_merged')
+
+
+def hash_path(path: str, sha: hashlib.sha1) -> None:
+    """Update hash with relative file names and file contents of path"""
+    if os.path.isfile(path):
+        files = [path]
+    elif os.path.isdir(path):
+        files = sorted(os.path.join(root, file) for root, _, names in os.walk(path) for file in names)
+    else:
+        logger.warning(f'Input {path} does not exist')
+        files = []
+    for file in files:
+        sha.update(os.path.relpath(file, path).encode())
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+
+
+class StageRunner:
+    """Run requested stages and their upstream stages in topological order, skipping cached ones"""
+
+    def __init__(self, config: DictConfig) -> None:
+        self.config = config
+        self.stages = config.pipeline.stages
+        self.force = config.pipeline.force
+        self.cache_path = os.path.join(config.dataset.out_dir, 'stage_cache.json')
+        self.keys = {}
+        self.outputs = {}  # identifier of the current outputs of each stage, part of the keys of downstream stages
+
+        unknown = set(self.stages) | set(self.force)
+        unknown -= set(STAGES.keys())
+        if unknown:
+            raise ValueError(f'Unknown stages, check -> {str(unknown)}')
+
+    def __call__(self) -> None:
+        cache = self.load_cache()
+        for stage in self.order():
+            self.keys[stage] = self.stage_key(stage)  # computed before running, stages may modify the config
+            upstream = {name: self.outputs[name] for name in STAGES[stage][1]}
+            entry = cache.get(stage, {})
+            if stage not in self.force and entry.get('key') == self.keys[stage]:
+                if os.path.exists(stage_dir(self.config, stage)):
+                    logger.info(f'Stage {stage} is up to date, skipping...')
+                    self.outputs[stage] = entry.get('output', entry['key'])
+                    continue
+            logger.info(f'Running stage {stage}...')
+            config = deepcopy(self.config)
+            if entry.get('upstream') != upstream:  # upstream outputs changed, do not reuse merged data
+                config.merge.overwrite = True
+            STAGES[stage][0](config)
+            self.outputs[stage] = self.output_id(stage)
+            cache[stage] = {'key': self.keys[stage], 'output': self.outputs[stage], 'upstream': upstream}
+            self.save_cache(cache)
+
+    def output_id(self, stage: str) -> str:
+        """Identifier of the outputs of a run, forced runs get a new one such that downstream stages rerun too"""
+        if stage in self.force:
+            return hashlib.sha1(f'{self.keys[stage]}:{uuid.uuid4()}'.encode()).hexdigest()
+        return self.keys[stage]
+
+    def order(self) -> list:
+        """Requested stages with all upstream stages in topological order"""
+        ordered = []
+
+        def visit(stage):
+            for upstream in STAGES[stage][1]:
+                visit(upstream)
+            if stage not in ordered:
+                ordered.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        return ordered
+
+    def stage_key(self, stage: str) -> str:
+        """Hash of upstream outputs, relevant config subtrees and input files, changes of the code are not detected"""
+        _, upstream, config_keys, input_keys = STAGES[stage]
+        sha = hashlib.sha1(stage.encode())
+        for name in upstream:
+            sha.update(self.outputs[name].encode())
+        for key in config_keys:
+            value = OmegaConf.select(self.config, key)
+            if isinstance(value, DictConfig) or OmegaConf.is_list(value):
+                value = OmegaConf.to_container(value, resolve=True)
+            sha.update(json.dumps({key: value}, sort_keys=True, default=str).encode())
+        for key in input_keys:
+            hash_path(OmegaConf.select(self.config, key), sha)
+        return sha.hexdigest()
+
+    def load_cache(self) -> dict:
+        if os.path.isfile(self.cache_path):
+            with open(self.cache_path) as f:
+                return json.load(f)
+        return {}
+
+    def save_cache(self, cache: dict) -> None:
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    @hydra.main(version_base=None, config_path='../config', config_name='config')
+    def main(config: DictConfig) -> None:
+        logger.remove()
+        logger.add(sys.stderr, level=config.logging_level)
+        runner = StageRunner(config)
+        runner()
+
+    main()
@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from pytest import fixture, mark
+from sklearn.feature_selection import RFECV
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import KFold
+
+from excel.analysis.utils.analyse_variables import (
+    AnalyseVariables,
+    FeatureReduction,
+    early_stop_rfe,
+    outlier_bounds,
+    outlier_mask,
+    outlier_table,
+    prune_correlated,
+    write_highlighted_outliers,
+)
+from excel.analysis.utils.plots import Plotter
+
+SCORING = {'classification': 'accuracy', 'regression': 'neg_mean_absolute_error'}
+
+rng = np.random.default_rng(0)
+X = pd.DataFrame(rng.normal(size=(60, 6)), columns=list('ABCDEF'))
+labels = {
+    'classification': (X['A'] + X['B'] > 0).astype(int),
+    'regression': 2 * X['A'] - X['B'] + rng.normal(scale=0.1, size=60),
+}
+
+
+def with_target(task: str) -> pd.DataFrame:
+    return pd.concat((X, labels[task].rename('target')), axis=1)
+
+
+@fixture(scope='function')
+def analysis(tmp_path):
+    """Correlation analysis dropping features correlated above 0.9, without plots"""
+    analysis = AnalyseVariables()
+    analysis.job_dir = str(tmp_path)
+    analysis.target_label = 'target'
+    analysis.seed = 0
+    analysis.corr_method = 'pearson'
+    analysis.corr_thresh = 0.9
+    analysis.corr_drop_features = True
+    analysis.corr_n_repeats = 2
+    analysis.scoring = SCORING
+    analysis.n_jobs = 2
+    analysis.plotter = Plotter('none')
+    return analysis
+
+
+@fixture(scope='function')
+def reduction(tmp_path):
+    """Feature reduction of a classification task, without plots"""
+    reduction = FeatureReduction()
+    reduction.job_dir = str(tmp_path)
+    reduction.target_label = 'target'
+    reduction.task = 'classification'
+    reduction.seed = 0
+    reduction.scoring = SCORING
+    reduction.n_jobs = 4
+    reduction.plotter = Plotter('none')
+    reduction.fr_all_estimators = ['forest', 'extreme_forest']
+    reduction.rfe_step = 3  # few elimination levels keep the test fast
+    return reduction
+
+
+@mark.feature_reduction
+class FeatureReductionTests:
+    @staticmethod
+    def test_fr_all_after_loky_job(reduction):
+        reduction.fr_forest(with_target('classification'))  # RFECV starts loky workers
+        data, features = reduction.fr_all(with_target('classification'))
+        assert 'target' in data.columns
+        assert set(features) <= set(X.columns) and features
+
+
+@mark.correlation
+class CorrelationImportanceTests:
+    @staticmethod
+    @mark.parametrize('task', ['classification', 'regression'])
+    @mark.parametrize('importance', ['permutation', 'impurity', 'univariate'])
+    def test_drop_correlated(analysis, task, importance):
+        analysis.task = task
+        analysis.corr_importance = importance
+        data = with_target(task)
+        data.insert(1, 'A2', data['A'] + rng.normal(scale=0.01, size=len(data)))  # redundant copy of A
+        result = analysis.correlation(data)
+        assert len({'A', 'A2'} & set(result.columns)) == 1
+        assert set(result.columns) - {'A', 'A2'} == set(X.columns[1:]) | {'target'}
+
+    @staticmethod
+    def test_keep_most_important(analysis):
+        analysis.task = 'regression'
+        analysis.corr_importance = 'univariate'
+        data = with_target('regression')
+        data.insert(0, 'P', data['target'] + rng.normal(scale=0.1, size=len(data)))  # first, but noisier than A
+        data['A'] = data['target'] + rng.normal(scale=0.01, size=len(data))
+        result = analysis.correlation(data)
+        assert 'A' in result.columns and 'P' not in result.columns
+
+
+@mark.correlation
+class PruneCorrelatedTests:
+    matrix = np.array(
+        [
+            [1.0, 0.95, 0.8],
+            [0.95, 1.0, 0.95],
+            [0.8, 0.95, 1.0],
+        ]
+    )
+
+    def test_greedy_keep_order(self):
+        """Features correlated only with dropped features are kept"""
+        np.testing.assert_array_equal(prune_correlated(self.matrix, 0.9), [True, False, True])
+
+    def test_importance_order(self):
+        """The most important feature is kept, as in AnalyseVariables.correlation"""
+        order = np.argsort(-np.array([0.1, 0.5, 0.2]), kind='stable')  # importances, feature 1 first
+        keep = np.zeros(3, dtype=bool)
+        keep[order] = prune_correlated(self.matrix[np.ix_(order, order)], 0.9)
+        np.testing.assert_array_equal(keep, [False, True, False])
+
+    def test_negative_and_undefined_correlation(self):
+        matrix = np.array([[1.0, -0.95, np.nan], [-0.95, 1.0, np.nan], [np.nan, np.nan, np.nan]])
+        np.testing.assert_array_equal(prune_correlated(matrix, 0.9), [True, False, True])
+
+
+@mark.feature_reduction
+class EarlyStopRFETests:
+    X = pd.DataFrame(rng.normal(size=(60, 8)), columns=list('ABCDEFGH'))
+    y = pd.Series(X.to_numpy()[:, :4] @ [4, 3, 2, 1] + rng.normal(scale=0.5, size=60))  # 4 informative features
+    cv = KFold(3, shuffle=True, random_state=0)
+
+    def test_matches_rfecv_without_early_stop(self):
+        support, cv_results, _, _ = early_stop_rfe(self.X, self.y, LinearRegression(), self.cv, 'r2', 1, np.inf, 1)
+        rfecv = RFECV(LinearRegression(), step=1, cv=self.cv, scoring='r2').fit(self.X, self.y)
+        np.testing.assert_array_equal(cv_results['n_features'], np.arange(1, 9))
+        np.testing.assert_allclose(cv_results['mean_test_score'], rfecv.cv_results_['mean_test_score'])
+        np.testing.assert_array_equal(support, rfecv.support_)
+
+    def test_early_stop(self):
+        tol = 0.05
+        support, cv_results, estimator, _ = early_stop_rfe(self.X, self.y, LinearRegression(), self.cv, 'r2', 1, tol, 1)
+        scores = cv_results['mean_test_score'][::-1]  # descending number of features
+        assert cv_results['n_features'][0] > 1  # stops once informative features are eliminated
+        assert scores[-1] < scores[:-1].max() - tol
+        assert np.all(scores[1:-1] >= np.maximum.accumulate(scores)[:-2] - tol)  # no earlier stop
+        assert support.sum() == cv_results['n_features'][::-1][np.argmax(scores)] == len(estimator.coef_)
+        assert support[:4].all()
+
+
+@mark.outliers
+class OutlierTests:
+    data = pd.DataFrame(
+        {'a': [1.0, 2.0, 3.0, 4.0, 100.0], 'b': [-50.0, np.nan, 0.0, 1.0, 2.0]},
+        index=pd.Index(list('vwxyz'), name='subject'),
+    )
+
+    def test_bounds_and_mask(self):
+        values = self.data.to_numpy()
+        lower, upper = outlier_bounds(values)
+        np.testing.assert_allclose([lower[0], upper[0]], [-1.0, 7.0])  # quartiles 2 and 4
+        expected = np.zeros(values.shape, dtype=bool)
+        expected[4, 0] = expected[0, 1] = True  # missing values are no outliers
+        np.testing.assert_array_equal(outlier_mask(values, lower, upper), expected)
+
+    def test_matches_pandas(self):
+        data = pd.DataFrame(rng.standard_t(2, size=(40, 5)))
+        data.iloc[3, 1] = np.nan
+        q1, q3 = data.quantile(0.25), data.quantile(0.75)
+        lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        expected = data.le(lower) | data.ge(upper)
+        values = data.to_numpy()
+        np.testing.assert_array_equal(outlier_mask(values, *outlier_bounds(values)), expected.to_numpy())
+
+    def test_write_highlighted_outliers(self, tmp_path):
+        values = self.data.to_numpy()
+        lower, upper = outlier_bounds(values)
+        outliers = outlier_table(self.data, outlier_mask(values, lower, upper), lower, upper)
+        assert outliers[['subject', 'feature', 'value', 'bound']].values.tolist() == [
+            ['v', 'b', -50.0, lower[1]],
+            ['z', 'a', 100.0, 7.0],
+        ]
+        path = os.path.join(tmp_path, 'outliers.xlsx')
+        write_highlighted_outliers(path, self.data.assign(meta=1), outliers, lower, upper)
+        rules = {
+            str(rule.sqref): rule.rules[0].formula[0] for rule in load_workbook(path)['data'].conditional_formatting
+        }
+        assert rules == {  # one rule per feature, none for metadata, index is the first column
+            'B2:B6': 'AND(ISNUMBER(B2),OR(B2<=-1.0,B2>=7.0))',
+            'C2:C6': f'AND(ISNUMBER(C2),OR(C2<={lower[1]!r},C2>={upper[1]!r}))',
+        }
+        assert len(pd.read_excel(path, sheet_name='outliers')) == 2
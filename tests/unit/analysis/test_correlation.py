@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from pytest import mark
+
+from excel.analysis.utils.helpers import correlation_matrix
+
+rng = np.random.default_rng(0)
+df = pd.DataFrame(rng.normal(size=(50, 8)), columns=list('ABCDEFGH'))
+df['I'] = df['A'] * 2 + rng.normal(scale=0.1, size=50)  # strongly correlated
+df['J'] = rng.integers(0, 3, size=50)  # ties for rank correlation
+df['K'] = 1.0  # constant
+
+
+@mark.correlation
+class CorrelationTests:
+    @staticmethod
+    @mark.parametrize('method', ['pearson', 'spearman'])
+    def test_matches_pandas(method):
+        expected = df.corr(method=method)
+        result = correlation_matrix(df, method)
+        pd.testing.assert_frame_equal(result, expected, atol=1e-10)
+
+    @staticmethod
+    @mark.parametrize('method', ['pearson', 'spearman'])
+    def test_blocked_matches_pandas(method):
+        expected = df.corr(method=method)
+        result = correlation_matrix(df, method, block_size=3)
+        pd.testing.assert_frame_equal(result, expected, atol=1e-10)
+
+    @staticmethod
+    def test_missing_values_fall_back_to_pandas():
+        data = df.copy()
+        data.iloc[0, 0] = np.nan
+        pd.testing.assert_frame_equal(correlation_matrix(data), data.corr())
@@ -0,0 +1,57 @@
+import numpy as np
+from pytest import mark
+from sklearn.experimental import enable_iterative_imputer  # because of bug in sklearn
+from sklearn.impute import IterativeImputer
+
+from excel.analysis.utils.imputers import BlockImputer, SubspaceKNNImputer
+
+rng = np.random.default_rng(0)
+x = rng.normal(size=40)
+noise = rng.normal(size=40)
+data = np.column_stack((2 * x, x, noise, -x, 3 * noise))  # columns 1 and 2 are complete
+data[[0, 5, 9], 0] = np.nan
+data[[3, 7], 3] = np.nan
+data[[2, 4], 4] = np.nan
+
+
+@mark.imputer
+class ImputerTests:
+    @staticmethod
+    @mark.parametrize('max_predictors', [1, 50])
+    def test_block_imputer_uses_complete_columns(max_predictors):
+        imputer = BlockImputer(IterativeImputer(random_state=0), block_size=1, max_predictors=max_predictors)
+        result = imputer.fit_transform(data)
+        missing = np.isnan(data)
+        expected = np.column_stack((2 * x, x, noise, -x, 3 * noise))
+        np.testing.assert_array_equal(result[~missing], data[~missing])  # observed values are kept
+        np.testing.assert_allclose(result[missing], expected[missing], atol=1e-2)  # predicted from correlated columns
+
+    @staticmethod
+    def test_block_imputer_without_missing_values():
+        complete = np.nan_to_num(data)
+        np.testing.assert_array_equal(BlockImputer(IterativeImputer()).fit_transform(complete), complete)
+
+    @staticmethod
+    def test_subspace_knn_imputer():
+        values = np.array(
+            [
+                [0.0, 1.0, np.nan],
+                [0.1, 1.0, np.nan],
+                [0.2, np.nan, np.nan],
+                [10.0, 5.0, np.nan],
+                [10.1, 7.0, np.nan],
+                [10.2, np.nan, np.nan],
+            ]
+        )
+        expected = np.array(
+            [
+                [0.0, 1.0, 0.0],
+                [0.1, 1.0, 0.0],
+                [0.2, 1.0, 0.0],  # mean of the two nearest neighbours
+                [10.0, 5.0, 0.0],
+                [10.1, 7.0, 0.0],
+                [10.2, 6.0, 0.0],
+            ]
+        )  # empty columns become zeros
+        result = SubspaceKNNImputer(n_neighbors=2).fit_transform(values)
+        np.testing.assert_allclose(result, expected)
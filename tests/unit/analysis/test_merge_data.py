@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+from pytest import fixture, mark
+
+from excel.analysis.utils.merge_data import MergeData, resample_curves
+
+TABLES = {  # table name -> name of the slice column
+    'roi_2d_long_axis_longit_strain': 'series, slice',
+    'roi_2d_short_axis_circumf_strain': 'slice',
+    'roi_2d_short_axis_radial_strain': 'slice',
+}
+SUBJECTS = {'sub1': list(TABLES), 'sub2': list(TABLES)[1:]}  # sub2 lacks the long axis table
+
+
+def roi_table(slice_col: str, rng) -> pd.DataFrame:
+    """Synthetic ROI table with slice-wise global rows and an irrelevant ROI, which are removed"""
+    info = pd.DataFrame(
+        {
+            'roi': ['global', 'global', 'endo', 'endo', 'epi', 'other'],
+            slice_col: ['all slices', 'slice 1', 'slice 1', 'slice 2', 'slice 1', 'slice 1'],
+        }
+    )
+    samples = pd.DataFrame(rng.normal(size=(6, 5)), columns=[f'sample {i}' for i in range(5)])
+    times = pd.DataFrame(np.tile([0.0, 0.1, 0.3, 0.6, 1.0], (6, 1)), columns=[f'time {i}' for i in range(5)])
+    return pd.concat((info, samples, times), axis=1)
+
+
+@fixture(scope='function')
+def merger(tmp_path):
+    """MergeData on synthetic checked tables of two subjects"""
+    rng = np.random.default_rng(0)
+    for subject, tables in SUBJECTS.items():
+        subject_dir = os.path.join(tmp_path, '4_checked', 'lenient', subject, 'tables')
+        os.makedirs(subject_dir)
+        for table_name in tables:
+            roi_table(TABLES[table_name], rng).to_excel(
+                os.path.join(subject_dir, f'{table_name}_({subject}).xlsx'), index=False
+            )
+        open(os.path.join(subject_dir, f'{list(TABLES)[0]}_(notes).txt'), 'w').close()  # ignored, no table
+    config = OmegaConf.create(
+        {
+            'dataset': {'out_dir': str(tmp_path), 'dims': ['2d'], 'strict': False, 'mdata_src': ''},
+            'merge': {'peak_values': True, 'workers': 1, 'stacked': False, 'time_points': 11},
+            'analysis': {
+                'experiment': {
+                    'name': 'test',
+                    'target_label': 'mace',
+                    'axes': ['short_axis', 'long_axis'],
+                    'orientations': ['radial', 'circumf', 'longit'],
+                    'metrics': ['strain'],
+                    'segments': ['roi'],
+                    'metadata': [],
+                },
+                'run': {'seed': 0},
+            },
+        }
+    )
+    merger = MergeData(config)
+    merger.cache_path()  # identify tables and build index
+    return merger
+
+
+@mark.merge
+class MergeDataTests:
+    @staticmethod
+    def test_schema(merger):
+        assert merger.relevant == sorted(TABLES)
+        assert merger.col_names == [
+            f'{row}_{orientation}_strain'
+            for orientation in ['longit', 'circumf', 'radial']
+            for row in ['global', 'endo', 'epi']
+        ]
+        assert merger.col_slices['roi_2d_short_axis_circumf_strain'] == slice(3, 6)
+
+    @staticmethod
+    def test_index(merger):
+        assert sorted(merger.index) == sorted(SUBJECTS)
+        for subject, tables in SUBJECTS.items():
+            assert sorted(merger.index[subject]) == sorted(tables)
+            for table_name, file_path in merger.index[subject].items():
+                assert os.path.basename(file_path) == f'{table_name}_({subject}).xlsx'
+
+    @staticmethod
+    def test_peak_values(merger):
+        features, _ = merger.subject_features('sub1')
+        table = pd.read_excel(merger.index['sub1']['roi_2d_short_axis_radial_strain'])
+        samples = table.filter(regex='sample')
+        assert np.isclose(features[6], samples.iloc[0].max())  # radial strain peaks at maximum
+        assert np.isclose(features[7], samples.iloc[2:4].max(axis=1).mean())  # mean over endo slices
+        assert np.isnan(merger.subject_features('sub2')[0][:3]).all()  # missing table stays NaN
+
+    @staticmethod
+    def test_stacked_matches_subject_wise(merger):
+        subjects = sorted(SUBJECTS)
+        expected = np.stack([merger.subject_features(subject)[0] for subject in subjects])
+        matrix = np.full((len(subjects), len(merger.col_names)), np.nan)
+        merger.stacked_features(subjects, matrix)
+        np.testing.assert_allclose(matrix, expected, equal_nan=True)
+
+    @staticmethod
+    def test_curves(merger):
+        merger.peak_values = False
+        _, curves = merger.subject_features('sub1')
+        assert curves.shape == (len(merger.col_names), 11)
+        table = pd.read_excel(merger.index['sub1']['roi_2d_short_axis_radial_strain'])
+        samples = table.filter(regex='sample').to_numpy()
+        np.testing.assert_allclose(curves[6, [0, -1]], samples[0, [0, -1]], rtol=1e-6)  # global, end points kept
+
+    @staticmethod
+    def test_cache_path(merger):
+        def cache_path(**merge):
+            config = merger.config.copy()
+            config.merge = {**merger.config.merge, **merge}
+            return MergeData(config).cache_path()
+
+        assert cache_path(stacked=True, workers=4, imputation={'estimator': 'knn'}) == merger.cache_path()
+        assert cache_path(time_points=20) == merger.cache_path()  # no curves with peak values
+        assert cache_path(peak_values=False) != merger.cache_path()
+        assert cache_path(peak_values=False, time_points=20) != cache_path(peak_values=False)
+
+    @staticmethod
+    def test_resample_curves():
+        times = np.array([0.0, 1.0, 3.0, 4.0])
+        values = np.stack((2 * times, -times))
+        grid = np.linspace(0, 4, 5)
+        np.testing.assert_allclose(resample_curves(times, values, 5), np.stack((2 * grid, -grid)))
+        assert np.isnan(resample_curves(times[:1], values[:, :1], 5)).all()  # too few samples
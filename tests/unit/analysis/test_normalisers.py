@@ -91,3 +91,30 @@ class NormaliserTests:
         )
         result = normaliser.power_norm(element).round(6)
         assert result.equals(expected) is True
+
+    @staticmethod
+    @mark.parametrize('element', [df])
+    def test_auto_norm(element, normaliser):
+        normaliser.target_label = 'D'
+        normaliser.auto_norm_method = {'binary': 'z_score_norm', 'continuous': 'min_max_norm'}
+        expected = pd.DataFrame(
+            {
+                'A': [0, 0, 0],  # constant columns are left as is
+                'B': [-0.707107, 1.414214, -0.707107],
+                'C': [0.0, 0.5, 1.0],
+                'D': [1, 2, 3],
+            }
+        )
+        result = normaliser.auto_norm(element).round(6)
+        assert result.equals(expected) is True
+
+    @staticmethod
+    @mark.parametrize('element', [df])
+    def test_fit_apply_norm(element, normaliser):
+        normaliser.target_label = 'D'
+        scaler = normaliser.fit_norm(element, 'min_max_norm')
+        assert normaliser.fit_norm(element, 'min_max_norm') is scaler  # fitted once
+        test = pd.DataFrame({'A': [0, 0], 'B': [3, 0], 'C': [2, -1], 'D': [4, 5]})
+        expected = pd.DataFrame({'A': [0.0, 0.0], 'B': [2.0, -1.0], 'C': [1.5, 0.0], 'D': [4, 5]})
+        result = normaliser.apply_norm(test, scaler).round(6)
+        assert result.equals(expected) is True
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+from openpyxl import load_workbook
+from pytest import mark, raises
+
+from excel.other_tasks.cleanup import cleanup, export_fast, highlight_cols, strip_units
+
+
+def redcap_export(record_ids: list, values: list) -> pd.DataFrame:
+    """Export with a second header row, 10 info columns after record_id and one measurement column"""
+    info = {f'info_{i}': ['label'] + ['x'] * len(record_ids) for i in range(10)}
+    return pd.DataFrame({'record_id': ['id'] + record_ids, **info, 'lvef': ['unit'] + values})
+
+
+@mark.cleanup
+class CleanupTests:
+    @staticmethod
+    def test_strip_units():
+        data = pd.DataFrame({'a': pd.Series(['55 %', '1.2 ml/m²', '0', '', None, 'n', 7], dtype=object)})
+        expected = [55.0, 1.2, np.nan, np.nan, np.nan, np.nan, 7.0]
+        np.testing.assert_array_equal(strip_units(data)['a'].to_numpy(), expected)
+
+    @staticmethod
+    def test_strip_units_keeps_numeric_cells():
+        """Numeric cells keep their value and sign, only text cells lose the '-' with their units"""
+        data = pd.DataFrame({'a': pd.Series([-3, 2.5, '-5 mm', 0], dtype=object), 'b': [-1.0, 0.0, np.nan, 4.0]})
+        result = strip_units(data)
+        np.testing.assert_array_equal(result['a'].to_numpy(), [-3.0, 2.5, 5.0, np.nan])
+        np.testing.assert_array_equal(result['b'].to_numpy(), [-1.0, np.nan, np.nan, 4.0])
+
+    @staticmethod
+    @mark.parametrize('file_format', ['parquet', 'csv'])
+    def test_export_fast(tmp_path, file_format):
+        mixed = pd.Series([3, 'a', np.nan], dtype=object)
+        data = pd.DataFrame({'record_id': [1, 2, 3], 'mixed': mixed, 'value': [1.5, np.nan, 2.0]})
+        export_fast(data, os.path.join(tmp_path, 'combined'), file_format)
+        path = os.path.join(tmp_path, f'combined.{file_format}')
+        result = pd.read_parquet(path) if file_format == 'parquet' else pd.read_csv(path)
+        assert result['mixed'].tolist()[:2] == ['3', 'a']
+        assert result['mixed'].isna().tolist() == [False, False, True]  # missing values are not written as 'nan'
+        np.testing.assert_array_equal(result['value'].to_numpy(), [1.5, np.nan, 2.0])
+
+    @staticmethod
+    def test_export_fast_invalid_format(tmp_path):
+        with raises(ValueError):
+            export_fast(pd.DataFrame({'a': [1]}), os.path.join(tmp_path, 'combined'), 'json')
+
+    @staticmethod
+    def test_highlight_cols(tmp_path):
+        data = pd.DataFrame({'record_id': [1], 'lvef_a': [1.0], 'lvef_b': [2.0], 'lvef_ab': [3.0]})
+        path = os.path.join(tmp_path, 'combined.xlsx')
+        with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+            data.to_excel(writer, sheet_name='combined', index=False)
+            highlight_cols(writer, data, ['a', 'b', 'ab'], ['#D3D3D3', '#F08080', '#FFFFE0'])
+        columns = load_workbook(path)['combined'].column_dimensions
+        fills = {letter: columns[letter].fill.fgColor.rgb for letter in 'BCD'}
+        assert fills == {'B': 'FFD3D3D3', 'C': 'FFF08080', 'D': 'FFFFFFE0'}  # suffix _ab is not _b
+        assert columns['A'].fill.fgColor.rgb != 'FFD3D3D3'
+
+    @staticmethod
+    def test_cleanup(tmp_path):
+        redcap_export(['2', '1'], ['60 %', '0']).to_excel(os.path.join(tmp_path, 'a.xlsx'), index=False)
+        redcap_export(['1', '3', '3'], ['50', '45 %', '40 %']).to_excel(os.path.join(tmp_path, 'b.xlsx'), index=False)
+        config = OmegaConf.create(
+            {'src_dir': str(tmp_path), 'files': {'a': 'a.xlsx', 'b': 'b.xlsx'}, 'fast_format': 'csv'}
+        )
+        cleanup.__wrapped__(config)  # bypass hydra's config loading
+
+        combined = pd.read_csv(os.path.join(tmp_path, 'combined.csv')).set_index('record_id')
+        np.testing.assert_array_equal(combined.index, [1, 2, 3])
+        np.testing.assert_array_equal(combined['lvef_a'], [np.nan, 60.0, np.nan])
+        np.testing.assert_array_equal(combined['lvef_b'], [50.0, np.nan, 45.0])  # first duplicate kept
+        assert set(pd.read_excel(os.path.join(tmp_path, 'combined.xlsx'), sheet_name=None)) == {'a', 'b', 'combined'}
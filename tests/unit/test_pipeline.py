@@ -0,0 +1,87 @@
+import os
+
+from omegaconf import OmegaConf
+from pytest import fixture, mark
+
+from excel import pipeline
+
+
+@fixture(scope='function')
+def stages(monkeypatch, tmp_path):
+    """Chain of stages a -> b -> c writing to tmp_path, returns the list of stages run with their merge.overwrite"""
+    runs = []
+
+    def stage(name):
+        def run(config):
+            runs.append((name, config.merge.overwrite))
+            os.makedirs(os.path.join(config.dataset.out_dir, name), exist_ok=True)
+
+        return run
+
+    monkeypatch.setattr(
+        pipeline,
+        'STAGES',
+        {
+            'a': (stage('a'), [], ['params.a'], ['inputs.a']),
+            'b': (stage('b'), ['a'], ['params.b'], []),
+            'c': (stage('c'), ['b'], [], []),
+        },
+    )
+    monkeypatch.setattr(pipeline, 'stage_dir', lambda config, name: os.path.join(config.dataset.out_dir, name))
+    with open(os.path.join(tmp_path, 'input.txt'), 'w') as f:
+        f.write('raw data')
+    return runs
+
+
+def stage_config(tmp_path, force: list = None, a: int = 1, b: int = 1):
+    return OmegaConf.create(
+        {
+            'dataset': {'out_dir': str(tmp_path)},
+            'pipeline': {'stages': ['c'], 'force': force or [], 'workers': 1},
+            'merge': {'overwrite': False},
+            'params': {'a': a, 'b': b},
+            'inputs': {'a': os.path.join(tmp_path, 'input.txt')},
+        }
+    )
+
+
+def run_stages(runs: list, config) -> list:
+    """Names of the stages run by one invocation of the stage runner"""
+    runs.clear()
+    pipeline.StageRunner(config)()
+    return [name for name, _ in runs]
+
+
+@mark.pipeline
+class StageRunnerTests:
+    @staticmethod
+    def test_key_stability(stages, tmp_path):
+        first, second = pipeline.StageRunner(stage_config(tmp_path)), pipeline.StageRunner(stage_config(tmp_path))
+        first()
+        second()
+        assert first.keys == second.keys
+        assert run_stages(stages, stage_config(tmp_path)) == []
+
+    @staticmethod
+    def test_upstream_invalidation(stages, tmp_path):
+        assert run_stages(stages, stage_config(tmp_path)) == ['a', 'b', 'c']
+        assert run_stages(stages, stage_config(tmp_path, b=2)) == ['b', 'c']
+        assert run_stages(stages, stage_config(tmp_path, a=2, b=2)) == ['a', 'b', 'c']
+        with open(os.path.join(tmp_path, 'input.txt'), 'w') as f:
+            f.write('new raw data')
+        assert run_stages(stages, stage_config(tmp_path, a=2, b=2)) == ['a', 'b', 'c']
+        assert run_stages(stages, stage_config(tmp_path, a=2, b=2)) == []
+
+    @staticmethod
+    def test_missing_output_reruns_stage(stages, tmp_path):
+        run_stages(stages, stage_config(tmp_path))
+        os.rmdir(os.path.join(tmp_path, 'b'))
+        assert run_stages(stages, stage_config(tmp_path)) == ['b']  # same outputs, downstream is up to date
+
+    @staticmethod
+    def test_force_propagation(stages, tmp_path):
+        run_stages(stages, stage_config(tmp_path))
+        assert run_stages(stages, stage_config(tmp_path, force=['b'])) == ['b', 'c']
+        assert stages[-1] == ('c', True)  # upstream outputs changed, merged data is not reused
+        assert run_stages(stages, stage_config(tmp_path)) == []  # forced outputs are cached afterwards
+        assert run_stages(stages, stage_config(tmp_path, force=['a'])) == ['a', 'b', 'c']